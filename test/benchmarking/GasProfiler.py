@@ -0,0 +1,411 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Operation count and gas proxy of candidate formulas for the on-chain
+# 64.64 fixed point math (ABDKMath64x64), before they are written in
+# Solidity.
+#
+# A formula is a python function f(m, *args) written against the primitive
+# API of Tracer m (add, sub, mul, div, neg, abs, exp, ln, sqrt, comparisons,
+# select, branch), mirroring the Solidity code. The tracer evaluates it on
+# numpy arrays of inputs at once:
+#   - values are 64.64 numbers held as python ints in object arrays.
+#     add/sub/mul/div/neg/abs/sqrt are bit exact to ABDKMath64x64, exp and ln
+#     are evaluated at double precision
+#   - results outside the int128 range, division by 0, exp overflow and
+#     ln/sqrt of invalid arguments revert on chain: the input is flagged in
+#     m.reverted and excluded from the error statistics
+#   - every primitive call is counted per input. Inside "with m.branch(cond):"
+#     only the inputs with cond count (and can revert), so an if/else in
+#     Solidity is written as two branches and a select
+#   - gas = sum of counts * weights (DEFAULT_GAS_WEIGHTS or custom)
+#
+# profile() evaluates candidates for the same function against a float
+# reference and pareto_front() keeps the candidates for which no other
+# candidate is both cheaper and more accurate.
+#
+# usage: python GasProfiler.py [num_inputs]
+
+import sys
+import math
+import numpy as np
+from contextlib import contextmanager
+
+ONE_64x64 = 1 << 64
+TWO_64x64 = 2 << 64
+FOUR_64x64 = 4 << 64
+HALF_64x64 = 1 << 63
+MIN_64x64 = -(1 << 127)
+MAX_64x64 = (1 << 127) - 1
+# ABDKMath64x64.exp reverts at x >= 0x400000000000000000, returns 0 below -that
+EXP_LIMIT_64x64 = 0x400000000000000000
+
+# rough gas estimates per ABDKMath64x64 call including the internal call
+# overhead; calibrate with a gas reporter before relying on absolute values
+DEFAULT_GAS_WEIGHTS = {"add": 40, "sub": 40, "mul": 60, "div": 150, "neg": 30, "abs": 40, "cmp": 20,
+                       "exp": 2600, "ln": 2800, "sqrt": 900}
+
+def fixed(v):
+    """float -> 64.64 constant (rounded to the nearest 2^-64)"""
+    return int(round(v*2.0**64))
+
+def from_float(x):
+    """float array -> 64.64 object array"""
+    return np.frompyfunc(fixed, 1, 1)(np.asarray(x, dtype=float).reshape(-1)).astype(object)
+
+def to_float(x):
+    """64.64 values -> float array"""
+    return np.frompyfunc(lambda v: v/2**64, 1, 1)(np.asarray(x, dtype=object)).astype(float)
+
+def _div_scalar(x, y):
+    # Solidity: int256(x) << 64 / y, truncated towards 0
+    if y == 0:
+        return None
+    q = (abs(x) << 64)//abs(y)
+    return -q if (x < 0) != (y < 0) else q
+
+def _exp_scalar(x):
+    if x >= EXP_LIMIT_64x64:
+        return None
+    if x < -EXP_LIMIT_64x64:
+        return 0
+    return int(math.exp(x/2**64)*2.0**64)
+
+def _ln_scalar(x):
+    if x <= 0:
+        return None
+    return int((math.log(x) - 64*math.log(2))*2.0**64)
+
+def _sqrt_scalar(x):
+    if x < 0:
+        return None
+    return math.isqrt(x << 64)
+
+_div = np.frompyfunc(_div_scalar, 2, 1)
+_exp = np.frompyfunc(_exp_scalar, 1, 1)
+_ln = np.frompyfunc(_ln_scalar, 1, 1)
+_sqrt = np.frompyfunc(_sqrt_scalar, 1, 1)
+
+
+class Tracer:
+    """Counting evaluator of 64.64 primitives over num_inputs inputs
+
+    Args:
+        num_inputs (int): number of inputs evaluated at once
+    """
+    def __init__(self, num_inputs):
+        self.n = num_inputs
+        self.active = np.ones(num_inputs, dtype=bool)
+        self.reverted = np.zeros(num_inputs, dtype=bool)
+        self.counts = {op: np.zeros(num_inputs, dtype=np.int64) for op in DEFAULT_GAS_WEIGHTS}
+
+    def _count(self, op):
+        self.counts[op] += self.active
+
+    def _check(self, res):
+        # None marks a revert, int128 overflow reverts too
+        res = np.broadcast_to(np.asarray(res, dtype=object), (self.n,))
+        bad = np.frompyfunc(lambda v: v is None or v < MIN_64x64 or v > MAX_64x64, 1, 1)(res).astype(bool)
+        if np.any(bad):
+            self.reverted |= bad & self.active
+            res = np.where(bad, 0, res)
+        return res
+
+    @contextmanager
+    def branch(self, cond):
+        """Only inputs with cond count inside the block"""
+        prev = self.active
+        self.active = prev & np.asarray(cond, dtype=bool)
+        try:
+            yield
+        finally:
+            self.active = prev
+
+    def add(self, x, y):
+        self._count("add")
+        return self._check(np.add(x, y, dtype=object))
+
+    def sub(self, x, y):
+        self._count("sub")
+        return self._check(np.subtract(x, y, dtype=object))
+
+    def mul(self, x, y):
+        self._count("mul")
+        return self._check(np.right_shift(np.multiply(x, y, dtype=object), 64))
+
+    def div(self, x, y):
+        self._count("div")
+        return self._check(_div(x, y))
+
+    def neg(self, x):
+        self._count("neg")
+        return self._check(np.negative(x, dtype=object))
+
+    def abs(self, x):
+        self._count("abs")
+        return self._check(np.abs(np.asarray(x, dtype=object)))
+
+    def exp(self, x):
+        self._count("exp")
+        return self._check(_exp(x))
+
+    def ln(self, x):
+        self._count("ln")
+        return self._check(_ln(x))
+
+    def sqrt(self, x):
+        self._count("sqrt")
+        return self._check(_sqrt(x))
+
+    def lt(self, x, y):
+        self._count("cmp")
+        return np.broadcast_to(np.less(x, y, dtype=object).astype(bool), (self.n,))
+
+    def gt(self, x, y):
+        self._count("cmp")
+        return np.broadcast_to(np.greater(x, y, dtype=object).astype(bool), (self.n,))
+
+    def select(self, cond, x, y):
+        # result of an if/else, the comparison is counted by lt/gt
+        return np.where(cond, np.broadcast_to(np.asarray(x, dtype=object), (self.n,)),
+                        np.broadcast_to(np.asarray(y, dtype=object), (self.n,)))
+
+    def gas(self, weights=None):
+        """Gas proxy per input"""
+        weights = DEFAULT_GAS_WEIGHTS if weights is None else weights
+        return sum(self.counts[op]*weights.get(op, 0) for op in self.counts)
+
+
+def profile(candidates, inputs, reference, weights=None, relative=False):
+    """Evaluate candidate formulas for the same function
+
+    Args:
+        candidates (dict): name -> formula f(m, *inputs)
+        inputs (tuple): float arrays of equal length, converted to 64.64
+        reference (np.ndarray): float reference values
+        weights (dict): gas per primitive, default DEFAULT_GAS_WEIGHTS
+        relative (bool): relative instead of absolute errors
+
+    Returns:
+        dict: name -> dict with max_error, mean_gas, max_gas, mean op
+            counts (ops) and number of reverted inputs
+    """
+    args = tuple(from_float(x) for x in inputs)
+    res = dict()
+    for name, f in candidates.items():
+        m = Tracer(args[0].shape[0])
+        y = to_float(f(m, *args))
+        err = np.abs(y - reference)
+        if relative:
+            err = err/np.abs(reference)
+        ok = ~m.reverted
+        gas = m.gas(weights)
+        res[name] = {"max_error": np.max(err[ok]) if np.any(ok) else np.nan,
+                     "mean_gas": np.mean(gas), "max_gas": np.max(gas),
+                     "ops": {op: np.mean(c) for op, c in m.counts.items() if np.any(c > 0)},
+                     "reverted": int(np.sum(m.reverted))}
+    return res
+
+def pareto_front(results):
+    """Names of the candidates not dominated in (mean_gas, max_error), cheapest first"""
+    names = sorted(results, key=lambda name: (results[name]["mean_gas"], results[name]["max_error"]))
+    front = []
+    best_err = np.inf
+    for name in names:
+        if results[name]["max_error"] < best_err:
+            front.append(name)
+            best_err = results[name]["max_error"]
+    return front
+
+def print_report(title, results):
+    front = pareto_front(results)
+    print(title)
+    for name in sorted(results, key=lambda name: results[name]["mean_gas"]):
+        r = results[name]
+        ops = ", ".join("{} {:.3g}".format(op, c) for op, c in r["ops"].items())
+        print("  {} {:28s} gas mean {:7.0f} max {:7.0f}  max error {:.2e}  reverted {}  ({})".format(
+            "*" if name in front else " ", name, r["mean_gas"], r["max_gas"], r["max_error"], r["reverted"], ops))
+    print("  * Pareto front")
+
+# candidate normal cdf approximations
+
+def normal_cdf_amm(m, x):
+    # AMMPerpLogic._normalCDF
+    is_negative = m.lt(x, 0)
+    with m.branch(is_negative):
+        x_neg = m.neg(x)
+    x = m.select(is_negative, x_neg, x)
+    is_large = m.gt(x, FOUR_64x64)
+    with m.branch(~is_large):
+        y = m.add(m.mul(x, 0x023a6ce358298c), -0x216c61522a6f3f)
+        y = m.add(m.mul(x, y), 0xc9320d9945b6c3)
+        y = m.add(m.mul(x, y), -0x01bcfd4bf0995aaf)
+        y = m.add(m.mul(x, y), -0x086de76427c7c501)
+        y = m.exp(m.neg(m.mul(m.add(m.mul(x, y), 0x749741d084e83004), x)))
+        y = m.add(m.mul(y, 0xcc42299ea1b28805), x)
+        y = m.div(m.div(m.exp(m.neg(m.mul(m.mul(x, x), HALF_64x64))), 0x0281b263fec4e0a007), y)
+    y = m.select(is_large, 0, y)
+    with m.branch(~is_negative):
+        y_pos = m.sub(ONE_64x64, y)
+    return m.select(is_negative, y, y_pos)
+
+def _logistic_cdf(c):
+    # 1/(1+exp(-c*x)), bad_cdf_approximation for c = 1.65451
+    c64 = fixed(c)
+    def f(m, x):
+        return m.div(ONE_64x64, m.add(ONE_64x64, m.exp(m.neg(m.mul(x, c64)))))
+    return f
+
+def _upper_half(m, x, tail):
+    # evaluates tail(|x|) = 1 - Phi(|x|) and maps it to Phi(x)
+    is_negative = m.lt(x, 0)
+    with m.branch(is_negative):
+        x_neg = m.neg(x)
+    ax = m.select(is_negative, x_neg, x)
+    q = tail(m, ax)
+    with m.branch(~is_negative):
+        y_pos = m.sub(ONE_64x64, q)
+    return m.select(is_negative, q, y_pos)
+
+def _as_26_2_17(m, x):
+    # Abramowitz & Stegun 26.2.17, |error| < 7.5e-8
+    t = m.div(ONE_64x64, m.add(ONE_64x64, m.mul(x, fixed(0.2316419))))
+    b = [fixed(c) for c in (1.330274429, -1.821255978, 1.781477937, -0.356563782, 0.319381530)]
+    poly = b[0]
+    for c in b[1:]:
+        poly = m.add(m.mul(t, poly), c)
+    poly = m.mul(t, poly)
+    pdf = m.mul(m.exp(m.neg(m.mul(m.mul(x, x), HALF_64x64))), fixed(1/math.sqrt(2*math.pi)))
+    return m.mul(pdf, poly)
+
+def _as_26_2_16(m, x):
+    # Abramowitz & Stegun 26.2.16, |error| about 1e-5
+    t = m.div(ONE_64x64, m.add(ONE_64x64, m.mul(x, fixed(0.33267))))
+    b = [fixed(c) for c in (0.9372980, -0.1201676, 0.4361836)]
+    poly = b[0]
+    for c in b[1:]:
+        poly = m.add(m.mul(t, poly), c)
+    poly = m.mul(t, poly)
+    pdf = m.mul(m.exp(m.neg(m.mul(m.mul(x, x), HALF_64x64))), fixed(1/math.sqrt(2*math.pi)))
+    return m.mul(pdf, poly)
+
+def _as_26_2_19(m, x):
+    # Abramowitz & Stegun 26.2.19, |error| < 1.5e-7, no exp: 0.5*(1+d1 x+...+d6 x^6)^-16
+    d = [fixed(c) for c in (0.0000053830, 0.0000488906, 0.0000380036, 0.0032776263, 0.0211410061,
+                                       0.0498673470)]
+    poly = d[0]
+    for c in d[1:]:
+        poly = m.add(m.mul(x, poly), c)
+    poly = m.add(m.mul(x, poly), ONE_64x64)
+    for _ in range(4):
+        poly = m.mul(poly, poly)
+    return m.div(HALF_64x64, poly)
+
+def normal_cdf_as_26_2_17(m, x):
+    return _upper_half(m, x, _as_26_2_17)
+
+def normal_cdf_as_26_2_16(m, x):
+    return _upper_half(m, x, _as_26_2_16)
+
+def normal_cdf_as_26_2_19(m, x):
+    return _upper_half(m, x, _as_26_2_19)
+
+NORMAL_CDF_CANDIDATES = {"AMMPerpLogic._normalCDF": normal_cdf_amm,
+                         "bad_cdf_approximation": _logistic_cdf(1.65451),
+                         "logistic 1.702": _logistic_cdf(1.702),
+                         "A&S 26.2.16": normal_cdf_as_26_2_16,
+                         "A&S 26.2.17": normal_cdf_as_26_2_17,
+                         "A&S 26.2.19 (no exp)": normal_cdf_as_26_2_19}
+
+# target collateral in quanto currency (AMMPerpLogic.getTargetCollateralM3)
+
+def target_collateral_m3_amm(m, K2, L1, s2, s3, sig2, sig3, rho, dd):
+    # as in the contract, kappa and v are computed twice
+    dd2 = m.mul(dd, dd)
+    v = m.neg(m.div(m.div(s3, s2), K2))
+    two_a = m.sub(m.exp(m.mul(sig3, sig3)), ONE_64x64)
+    two_a = m.sub(m.mul(two_a, dd2), ONE_64x64)
+    two_a = m.mul(m.mul(m.mul(two_a, v), v), TWO_64x64)
+    b = m.mul(m.sub(m.exp(m.mul(m.mul(sig2, sig3), rho)), ONE_64x64), TWO_64x64)
+    kappa = m.div(m.div(L1, s2), K2)
+    B = m.add(m.sub(m.mul(b, dd2), TWO_64x64), m.mul(kappa, TWO_64x64))
+    v = m.neg(m.div(m.div(s3, s2), K2))
+    B = m.mul(B, v)
+    c = m.sub(m.exp(m.mul(sig2, sig2)), ONE_64x64)
+    kappa = m.div(m.div(L1, s2), K2)
+    C = m.sub(m.add(m.sub(m.mul(c, dd2), m.mul(kappa, kappa)), m.mul(kappa, TWO_64x64)), ONE_64x64)
+    delta = m.sqrt(m.sub(m.mul(B, B), m.mul(m.mul(TWO_64x64, two_a), C)))
+    M1 = m.div(m.add(m.neg(B), delta), two_a)
+    M2 = m.div(m.sub(m.neg(B), delta), two_a)
+    return m.select(m.gt(M2, M1), M2, M1)
+
+def target_collateral_m3_shared(m, K2, L1, s2, s3, sig2, sig3, rho, dd):
+    # kappa and v computed once, 1/(s2*K2) shared, 2*x as x+x
+    dd2 = m.mul(dd, dd)
+    inv = m.div(ONE_64x64, m.mul(s2, K2))
+    v = m.neg(m.mul(s3, inv))
+    kappa = m.mul(L1, inv)
+    two_a = m.sub(m.mul(m.sub(m.exp(m.mul(sig3, sig3)), ONE_64x64), dd2), ONE_64x64)
+    two_a = m.mul(m.mul(two_a, v), v)
+    two_a = m.add(two_a, two_a)
+    b = m.sub(m.exp(m.mul(m.mul(sig2, sig3), rho)), ONE_64x64)
+    B = m.mul(m.add(m.sub(m.mul(m.add(b, b), dd2), TWO_64x64), m.add(kappa, kappa)), v)
+    C = m.sub(m.mul(m.sub(m.exp(m.mul(sig2, sig2)), ONE_64x64), dd2), m.mul(m.sub(kappa, ONE_64x64),
+              m.sub(kappa, ONE_64x64)))
+    two_a_c = m.mul(two_a, C)
+    delta = m.sqrt(m.sub(m.mul(B, B), m.add(two_a_c, two_a_c)))
+    M1 = m.div(m.add(m.neg(B), delta), two_a)
+    M2 = m.div(m.sub(m.neg(B), delta), two_a)
+    return m.select(m.gt(M2, M1), M2, M1)
+
+TARGET_COLLATERAL_M3_CANDIDATES = {"getTargetCollateralM3": target_collateral_m3_amm,
+                                   "shared subexpressions": target_collateral_m3_shared}
+
+def test_primitives():
+    m = Tracer(4)
+    x = from_float([1.5, -2.25, 0.1, 3])
+    y = from_float([2, 0.5, -0.3, 0])
+    assert(np.allclose(to_float(m.mul(x, y)), [3, -1.125, -0.03, 0]))
+    d = to_float(m.div(x, y))
+    assert(np.allclose(d[:3], [0.75, -4.5, -1/3]) and m.reverted[3] and m.reverted.sum() == 1)
+    # mul rounds towards -inf, div towards 0 as in ABDKMath64x64
+    assert(m.mul(-1, 1)[0] == -1 and m.div(-1, 3 << 64)[0] == 0)
+    assert(np.allclose(to_float(m.sqrt(from_float([4, 2, 0, 1e-6]))), [2, np.sqrt(2), 0, 1e-3]))
+    with m.branch(np.array([True, False, False, False])):
+        m.exp(x)
+    assert(list(m.counts["exp"]) == [1, 0, 0, 0])
+
+def test_normal_cdf():
+    from scipy.special import ndtr
+    x = to_float(from_float(np.linspace(-4, 4, 2001)))
+    res = profile(NORMAL_CDF_CANDIDATES, (x,), ndtr(x))
+    # within |x| <= 4, the error of _normalCDF beyond is the cutoff (Phi(-4) = 3.2e-5)
+    assert(res["AMMPerpLogic._normalCDF"]["max_error"] < 2e-7)
+    assert(res["A&S 26.2.17"]["max_error"] < 7.5e-8 and res["A&S 26.2.16"]["max_error"] < 1.2e-5)
+    assert(all(r["reverted"] == 0 for r in res.values()))
+    assert(res["bad_cdf_approximation"]["ops"] == {"add": 1, "mul": 1, "div": 1, "neg": 1, "exp": 1})
+
+if __name__ == "__main__":
+    from scipy.special import ndtr
+    from PricingBenchmark import get_target_collateral_M3_vec
+    test_primitives()
+    test_normal_cdf()
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = np.random.default_rng(0)
+    x = np.concatenate((np.linspace(-6, 6, n//2), rng.normal(0, 2, n - n//2)))
+    x = to_float(from_float(x))
+    print_report("normal cdf, x in [-6, 6] (" + str(n) + " inputs), absolute error vs scipy ndtr",
+                 profile(NORMAL_CDF_CANDIDATES, (x,), ndtr(x)))
+    # AMM states with K2 < 0, quanto collateral
+    K2 = -rng.uniform(0.1, 10, n)
+    s2 = np.exp(rng.uniform(np.log(100), np.log(50000), n))
+    s3 = np.exp(rng.uniform(np.log(100), np.log(50000), n))
+    L1 = K2*s2*rng.uniform(0.9, 1.1, n)
+    sig2, sig3 = rng.uniform(0.03, 0.1, n), rng.uniform(0.03, 0.1, n)
+    rho = rng.uniform(0.1, 0.9, n)
+    dd = rng.uniform(-3.5, -1.5, n)
+    inputs = tuple(to_float(from_float(v)) for v in (K2, L1, s2, s3, sig2, sig3, rho, dd))
+    ref = get_target_collateral_M3_vec(inputs[0], inputs[2], inputs[3], inputs[1], inputs[4], inputs[5],
+                                       inputs[6], 0, inputs[7])
+    print_report("target collateral M3 (" + str(n) + " inputs), relative error vs get_target_collateral_M3_vec",
+                 profile(TARGET_COLLATERAL_M3_CANDIDATES, inputs, ref, relative=True))
@@ -0,0 +1,255 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Generate reference ("golden") vectors from the Python pricing functions
+# so that AMMPerp.tests.ts and PerpMath.test.ts can be checked against
+# many more cases than the hand-copied values of test_default_probability,
+# test_pricing, test_target_collateral and test_casePerpMathTest*.
+#
+# Output formats:
+#   jsonl: one json object per line, keys = COLUMNS
+#   bin:   <name>.bin with little-endian float64 records of len(COLUMNS)
+#          values each (row-major) and <name>.json with the header
+#          {"columns": [...], "rows": n, "recordBytes": 8*len(COLUMNS), ...}
+#          record i starts at byte offset i*recordBytes, so a test can read
+#          single records lazily (fs.readSync with position)
+#
+# Undefined results are NaN in bin files and null in jsonl files. They are
+# not failures, a test compares the other columns of the row and skips the
+# NaN column:
+#   M3_target:             no collateral reaches targetDD (negative
+#                          discriminant of the quadratic in M3), about 11%
+#                          of the random rows
+#   pd_quanto, dd_quanto:  zero variance of the quanto default model
+#                          (M3 = 0 and M2 = K2), edge cases only
+# The .json header lists this under "nan".
+#
+# The default output golden_vectors.bin (about 176 MB for 1M cases) is
+# ignored by git.
+#
+# usage: python GoldenVectorExport.py [num_cases] [out_file(.jsonl|.bin)] [seed]
+
+import sys
+import json
+import time
+import numpy as np
+from PricingBenchmark import prob_def_no_quanto_vec, prob_def_quanto_vec, \
+    calculate_perp_price_vec, get_target_collateral_M1_vec, \
+    get_target_collateral_M2_vec, get_target_collateral_M3_vec
+
+COLUMNS = ["K2", "k", "L1", "s2", "s3", "sig2", "sig3", "rho", "r",
+           "M1", "M2", "M3", "minSpread", "targetDD",
+           "pd_no_quanto", "dd_no_quanto", "pd_quanto", "dd_quanto",
+           "price", "M1_target", "M2_target", "M3_target"]
+
+# columns that can be NaN (null in jsonl) and why, see header
+NAN_COLUMNS = {"M3_target": "target distance to default not reachable (negative discriminant)",
+               "pd_quanto": "zero variance of the quanto default model (M3 = 0 and M2 = K2)",
+               "dd_quanto": "zero variance of the quanto default model (M3 = 0 and M2 = K2)"}
+
+# share of each chunk that is drawn with M2-K2 close to zero
+NEAR_ZERO_SHARE = 0.1
+# share of non-quanto cases (M3=0)
+NO_QUANTO_SHARE = 0.5
+
+def sample_parameters(n, rng):
+    """Draw n random AMM states and trades
+
+    Args:
+        n (int): number of cases
+        rng (np.random.Generator): random number generator
+
+    Returns:
+        dict: parameter name -> array of length n
+    """
+    s2 = np.exp(rng.uniform(np.log(1), np.log(100000), n))
+    s3 = np.exp(rng.uniform(np.log(1), np.log(100000), n))
+    # long and short AMM exposure
+    K2 = rng.choice((-1, 1), n) * np.exp(rng.uniform(np.log(1e-3), np.log(100), n))
+    # locked-in value close to K2*s2 (entry price differs from index)
+    L1 = K2 * s2 * np.exp(rng.normal(0, 0.2, n))
+    sig2 = rng.uniform(0.01, 0.5, n)
+    sig3 = rng.uniform(0.01, 0.5, n)
+    rho = rng.uniform(-0.99, 0.99, n)
+    r = np.zeros(n)
+    M1 = np.where(rng.random(n) < 0.5, 0, np.abs(K2) * s2 * rng.uniform(0, 0.5, n))
+    M2 = np.abs(K2) * rng.uniform(0, 2, n)
+    # near-zero M2-K2
+    idx = rng.random(n) < NEAR_ZERO_SHARE
+    M2[idx] = K2[idx] + rng.choice((-1, 1), idx.sum()) * np.exp(rng.uniform(np.log(1e-9), np.log(1e-3), idx.sum()))
+    M3 = np.abs(K2) * s2 / s3 * rng.uniform(0, 1, n)
+    M3[rng.random(n) < NO_QUANTO_SHARE] = 0
+    # trade size, including no trade
+    k = K2 * rng.uniform(-1, 1, n)
+    k[rng.random(n) < 0.05] = 0
+    minSpread = rng.choice((0, 0.0001, 0.0002, 0.001, 0.02, 0.05), n)
+    targetDD = rng.uniform(-3.5, -1.5, n)
+    return {"K2": K2, "k": k, "L1": L1, "s2": s2, "s3": s3, "sig2": sig2,
+            "sig3": sig3, "rho": rho, "r": r, "M1": M1, "M2": M2, "M3": M3,
+            "minSpread": minSpread, "targetDD": targetDD}
+
+def edge_case_parameters():
+    """Hand-picked cases from PricingBenchmark.py plus extreme configurations
+
+    Returns:
+        dict: parameter name -> array
+    """
+    # K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread, targetDD
+    rows = np.array([
+        # test_default_probability / test_casePerpMathTest*
+        [0.4, 0, 0.4*36000, 38000, 2000, 0.05, 0.07, 0.5, 0, 10, 0.06, 0, 0.02, -2.32634787404084],
+        [0.4, 0, 0.4*36000, 38000, 2000, 0.05, 0.07, 0.5, 0, 10, 0.06, 0.04, 0.02, -2.32634787404084],
+        [0.4, 0, 0.4*36000, 38000, 2000, 0.05, 0.07, 0.5, 0, 10, 0.06, 0.2, 0.02, -2.32634787404084],
+        # test_pricing
+        [0.4, 0.1, 0.4*36000, 38000, 2000, 0.05, 0.07, 0.5, 0, 10, 0.06, 0.04, 0.02, -2.32634787404084],
+        [-0.4, 0.1, -0.4*36000, 38000, 2000, 0.05, 0.07, 0.5, 0, 10, 0.06, 0, 0.001, -2.32634787404084],
+        [0.4, 0.1, 0.4*36000, 38000, 2000, 0.05, 0.07, 0.5, 0, 10, 0.06, 0.04, 0.05, -2.32634787404084],
+        [0.4, -0.01, 0.4*36000, 38000, 2000, 0.05, 0.07, 0.5, 0, 10, 0.06, 0.02, 0.05, -2.32634787404084],
+        [0.4, 0.01, 0.4*36000, 38000, 2000, 0.05, 0.07, 0.5, 0, 10, 0.06, 0, 0.05, -2.32634787404084],
+        # test_target_collateral
+        [1, 0, -36000, 36000, 2000, 0.05, 0.07, 0.5, 0, 0, 0, 0, 0, -2.32634787404084],
+        # M2 == K2 (kStar = 0), both signs of L1+M1
+        [0.5, 0, 20000, 40000, 2000, 0.05, 0.07, 0.5, 0, 0, 0.5, 0, 0.0001, -2.5],
+        [0.5, 0, -20000, 40000, 2000, 0.05, 0.07, 0.5, 0, 0, 0.5, 0, 0.0001, -2.5],
+        # no default and sure default regions
+        [-1, 0, -40000, 40000, 2000, 0.05, 0.07, 0.5, 0, 0, 0, 0, 0.0001, -2.5],
+        [1, 0, 50000, 40000, 2000, 0.05, 0.07, 0.5, 0, -60000, 0, 0, 0.0001, -2.5],
+        # large trades relative to the AMM position
+        [0.1, 10, 4000, 40000, 2000, 0.05, 0.07, 0.5, 0, 0, 0.5, 0, 0.0001, -2.5],
+        [0.1, -10, 4000, 40000, 2000, 0.05, 0.07, 0.5, 0, 0, 0.5, 0.5, 0.0001, -2.5],
+    ])
+    return {name: rows[:, j] for j, name in enumerate(COLUMNS[:14])}
+
+def evaluate(p):
+    """Evaluate all reference functions on a batch of parameters
+
+    Args:
+        p (dict): output of sample_parameters or edge_case_parameters
+
+    Returns:
+        np.ndarray: array of shape (n, len(COLUMNS))
+    """
+    # the pd functions are evaluated at the post-trade state, the same
+    # state that calculate_perp_price uses
+    K2 = p["K2"] + p["k"]
+    L1 = p["L1"] + p["k"] * p["s2"]
+    args = (p["s2"], p["s3"], p["sig2"], p["sig3"], p["rho"], p["r"], p["M1"], p["M2"])
+    pd0, dd0 = prob_def_no_quanto_vec(K2, L1, *args, 0)
+    pd3, dd3 = prob_def_quanto_vec(K2, L1, *args, p["M3"])
+    price = calculate_perp_price_vec(p["K2"], p["k"], p["L1"], *args, p["M3"], p["minSpread"])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        M1_target = get_target_collateral_M1_vec(p["K2"], p["s2"], p["L1"], p["sig2"], p["targetDD"])
+        M2_target = get_target_collateral_M2_vec(p["K2"], p["s2"], p["L1"], p["sig2"], p["targetDD"])
+        M3_target = get_target_collateral_M3_vec(p["K2"], p["s2"], p["s3"], p["L1"], p["sig2"],
+                                                 p["sig3"], p["rho"], p["r"], p["targetDD"])
+    out = [p[name] for name in COLUMNS[:14]]
+    out += [pd0, dd0, pd3, dd3, price, M1_target, M2_target, M3_target]
+    return np.column_stack(out).astype("<f8")
+
+def _write_jsonl_chunk(f, data):
+    finite = np.all(np.isfinite(data), axis=1)
+    template = "{" + ",".join('"%s":%%r' % c for c in COLUMNS) + "}\n"
+    rows = data.tolist()
+    lines = []
+    for j, row in enumerate(rows):
+        if finite[j]:
+            lines.append(template % tuple(row))
+        else:
+            # json has no nan/inf, write null
+            lines.append(json.dumps({c: (v if np.isfinite(v) else None) for c, v in zip(COLUMNS, row)}) + "\n")
+    f.write("".join(lines))
+
+def export_golden_vectors(filename, num_cases, seed=42, chunk_size=100000):
+    """Sample num_cases random cases (plus the edge cases), evaluate them
+    in chunks and stream the result to filename
+
+    Args:
+        filename (str): output file, ending with .jsonl or .bin
+        num_cases (int): number of random cases
+        seed (int): seed of the random generator, same seed gives same file
+        chunk_size (int): number of cases evaluated per batch
+
+    Returns:
+        int: number of records written
+    """
+    is_binary = filename.endswith(".bin")
+    rng = np.random.default_rng(seed)
+    num_rows = 0
+    with open(filename, "wb" if is_binary else "w") as f:
+        chunks = [edge_case_parameters()]
+        remaining = num_cases
+        while len(chunks) > 0:
+            data = evaluate(chunks.pop())
+            if is_binary:
+                f.write(data.tobytes())
+            else:
+                _write_jsonl_chunk(f, data)
+            num_rows += data.shape[0]
+            if remaining > 0:
+                n = min(chunk_size, remaining)
+                chunks.append(sample_parameters(n, rng))
+                remaining -= n
+    if is_binary:
+        header = {"columns": COLUMNS, "rows": num_rows, "dtype": "float64",
+                  "byteOrder": "little", "recordBytes": 8*len(COLUMNS), "seed": seed, "nan": NAN_COLUMNS}
+        with open(filename[:-len(".bin")] + ".json", "w") as f:
+            json.dump(header, f, indent=2)
+    return num_rows
+
+def load_golden_vectors(filename):
+    """Load a binary golden vector file as a memory-mapped array
+
+    Args:
+        filename (str): .bin file written by export_golden_vectors
+
+    Returns:
+        (np.memmap, list): records of shape (rows, columns), column names
+    """
+    with open(filename[:-len(".bin")] + ".json") as f:
+        header = json.load(f)
+    data = np.memmap(filename, dtype="<f8", mode="r", shape=(header["rows"], len(header["columns"])))
+    return data, header["columns"]
+
+def test_vectorized_vs_scalar():
+    # check vectorized functions against the scalar ones in PricingBenchmark.py
+    import io
+    from contextlib import redirect_stdout
+    from PricingBenchmark import prob_def_no_quanto, prob_def_quanto, calculate_perp_price, \
+        get_target_collateral_M1, get_target_collateral_M2, get_target_collateral_M3
+    rng = np.random.default_rng(0)
+    p = sample_parameters(2000, rng)
+    data = evaluate(p)
+    expected = np.zeros((data.shape[0], 8))
+    # the scalar target collateral functions print their check
+    with redirect_stdout(io.StringIO()), np.errstate(divide='ignore', invalid='ignore'):
+        for j in range(data.shape[0]):
+            x = [p[c][j] for c in COLUMNS[:14]]
+            K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread, targetDD = x
+            pd0, dd0 = prob_def_no_quanto(K2+k, L1+k*s2, s2, s3, sig2, sig3, rho, r, M1, M2, 0)
+            pd3, dd3 = prob_def_quanto(K2+k, L1+k*s2, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
+            px = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread)
+            M1_target = get_target_collateral_M1(K2, s2, L1, sig2, targetDD)
+            M2_target = get_target_collateral_M2(K2, s2, L1, sig2, targetDD)
+            M3_target = get_target_collateral_M3(K2, s2, s3, L1, sig2, sig3, rho, r, targetDD)
+            expected[j] = [pd0, dd0, pd3, dd3, px, M1_target, M2_target, M3_target]
+    actual = data[:, 14:22]
+    # NaN/inf in exactly the same places, then compare the finite values
+    not_finite = ~np.isfinite(expected)
+    assert(np.array_equal(~np.isfinite(actual), not_finite))
+    assert(np.array_equal(actual[not_finite], expected[not_finite], equal_nan=True))
+    err = np.abs(actual - expected) / np.maximum(1, np.abs(expected))
+    max_err = np.max(err[~not_finite])
+    print("max relative difference vectorized vs. scalar = ", max_err)
+    assert(max_err < 1e-12)
+    # NaN only in the documented columns
+    nan_cols = [c for j, c in enumerate(COLUMNS) if np.any(~np.isfinite(data[:, j]))]
+    assert(set(nan_cols) <= set(NAN_COLUMNS))
+
+if __name__ == "__main__":
+    num_cases = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    filename = sys.argv[2] if len(sys.argv) > 2 else "golden_vectors.bin"
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 42
+    test_vectorized_vs_scalar()
+    t0 = time.time()
+    num_rows = export_golden_vectors(filename, num_cases, seed)
+    print("wrote", num_rows, "records to", filename, "in", np.round(time.time()-t0, 2), "s")
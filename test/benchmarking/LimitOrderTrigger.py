@@ -0,0 +1,318 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# In-memory model of the limit order book for keepers: instead of polling
+# all orders (LimitOrderBook.pollLimitOrders) the orders are indexed by
+# side, size and limit price (trigger price for stop orders, see Orders.md),
+# so that on each tick only orders that can be executed are evaluated.
+#
+# Conventions as in calculate_perp_price: amount k>0 is a buy (long) order,
+# k<0 a sell (short) order. A buy order is executable if the AMM price for
+# its amount is below the limit price, a sell order if the AMM price is
+# above the limit price. A stop buy order additionally requires
+# markprice > trigger, a stop sell order markprice < trigger.
+#
+# Orders are bucketed by log2(|k|): if the AMM price is monotone in k over a
+# bucket, all orders in the bucket have a fill price at least as bad as the
+# price at the better end of the bucket, and a binary search on the sorted
+# limit prices finds the only candidates of that bucket. Monotonicity is not
+# guaranteed (e.g., undercapitalised AMM, amounts around kStar), so on each
+# tick the price is sampled over each bucket at the bucket ends, at the
+# breakpoints of calculate_perp_price inside the bucket (kStar, M2-K2 and
+# the amount where -L1-M1 changes sign, from both sides) and at interior
+# points. Buckets where the sampled prices are not monotone are evaluated in
+# full. Without quanto the price is monotone between the breakpoints, with
+# quanto the check is a sampled one. The exact fill price is then evaluated
+# with calculate_perp_price_vec on the candidates only.
+
+import time
+import numpy as np
+from PricingBenchmark import calculate_perp_price_vec
+from test_liquidations import is_margin_safe
+from GoldenVectorExport import sample_parameters
+
+class _OrderGroup:
+    """Orders of one (side, stop/limit, size bucket) group, sorted by key
+    (limit price for limit orders, trigger price for stop orders)
+    """
+    def __init__(self):
+        self.keys = np.zeros(0)
+        self.idx = np.zeros(0, dtype=np.int64)
+        self.num_cancelled = 0
+
+    def insert(self, keys, idx):
+        order = np.argsort(keys, kind="stable")
+        keys, idx = keys[order], idx[order]
+        pos = np.searchsorted(self.keys, keys, side="right")
+        self.keys = np.insert(self.keys, pos, keys)
+        self.idx = np.insert(self.idx, pos, idx)
+
+    def compact(self, is_active):
+        keep = is_active[self.idx]
+        self.keys, self.idx = self.keys[keep], self.idx[keep]
+        self.num_cancelled = 0
+
+
+class LimitOrderTriggerEngine:
+    """Price-indexed limit and stop order book
+
+    Args:
+        capacity (int): initial number of order slots, grows as needed
+    """
+    def __init__(self, capacity=1024):
+        self.amount = np.zeros(capacity)
+        self.limit_price = np.zeros(capacity)
+        self.trigger_price = np.zeros(capacity)
+        self.is_active = np.zeros(capacity, dtype=bool)
+        self.num_orders = 0
+        self.groups = dict()
+
+    def __len__(self):
+        return int(np.sum(self.is_active[:self.num_orders]))
+
+    def _grow(self, n):
+        capacity = self.amount.shape[0]
+        if self.num_orders + n <= capacity:
+            return
+        new_capacity = max(2*capacity, self.num_orders + n)
+        for name in ("amount", "limit_price", "trigger_price", "is_active"):
+            arr = getattr(self, name)
+            new_arr = np.zeros(new_capacity, dtype=arr.dtype)
+            new_arr[:capacity] = arr
+            setattr(self, name, new_arr)
+
+    @staticmethod
+    def _bucket(amount):
+        return np.floor(np.log2(np.abs(amount))).astype(np.int64)
+
+    def _split_by_group(self, ids):
+        # yields (is_buy, is_stop, bucket), positions of ids in that group
+        bucket = self._bucket(self.amount[ids])
+        code = 4*bucket + 2*(self.amount[ids] > 0) + (self.trigger_price[ids] != 0)
+        order = np.argsort(code, kind="stable")
+        codes, start = np.unique(code[order], return_index=True)
+        for j, sel in enumerate(np.split(order, start[1:])):
+            c = int(codes[j])
+            yield (bool(c & 2), bool(c & 1), c >> 2), sel
+
+    def add_orders(self, amount, limit_price, trigger_price=None):
+        """Bulk insert of orders
+
+        Args:
+            amount (array): signed order amounts in base currency (non-zero)
+            limit_price (array): limit prices
+            trigger_price (array): trigger prices, 0 for plain limit orders
+
+        Returns:
+            np.ndarray: order ids (used for cancel_orders and in the
+                result of on_tick)
+        """
+        amount = np.asarray(amount, dtype=float)
+        limit_price = np.broadcast_to(np.asarray(limit_price, dtype=float), amount.shape)
+        if trigger_price is None:
+            trigger_price = np.zeros(amount.shape)
+        trigger_price = np.broadcast_to(np.asarray(trigger_price, dtype=float), amount.shape)
+        assert(np.all(amount != 0))
+        n = amount.shape[0]
+        self._grow(n)
+        ids = np.arange(self.num_orders, self.num_orders + n)
+        self.amount[ids] = amount
+        self.limit_price[ids] = limit_price
+        self.trigger_price[ids] = trigger_price
+        self.is_active[ids] = True
+        self.num_orders += n
+
+        keys = np.where(trigger_price != 0, trigger_price, limit_price)
+        for key, sel in self._split_by_group(ids):
+            if key not in self.groups:
+                self.groups[key] = _OrderGroup()
+            self.groups[key].insert(keys[sel], ids[sel])
+        return ids
+
+    def cancel_orders(self, ids):
+        """Bulk cancellation of orders (e.g., executed, expired or cancelled)
+
+        Args:
+            ids (array): order ids as returned by add_orders
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[self.is_active[ids]]
+        self.is_active[ids] = False
+        if ids.shape[0] == 0:
+            return
+        for key, sel in self._split_by_group(ids):
+            group = self.groups[key]
+            group.num_cancelled += sel.shape[0]
+            # cancelled orders stay in the group until they are the majority
+            if 2*group.num_cancelled > group.keys.shape[0]:
+                group.compact(self.is_active)
+
+    @staticmethod
+    def _bucket_bounds(amm_state, buckets):
+        # best possible fill price over each (is_buy, bucket) (lowest for
+        # buys, highest for sells) if the sampled prices are monotone in
+        # either direction, otherwise None. All samples are priced at once
+        s = amm_state
+        with np.errstate(divide='ignore', invalid='ignore'):
+            h = s["s3"]/s["s2"]*(np.exp(s["rho"]*s["sig2"]*s["sig3"])-1)/(np.exp(s["sig2"]**2)-1)*s["M3"]
+        k_break = np.array([s["M2"] - s["K2"] + (h if s["M3"] != 0 else 0), s["M2"] - s["K2"],
+                            (-s["L1"] - s["M1"])/s["s2"]])
+        k_break = k_break[np.isfinite(k_break)]
+        k_all = []
+        for is_buy, bucket in buckets:
+            lo, hi = 2.0**bucket, np.nextafter(2.0**(bucket + 1), 0)
+            kb = np.abs(k_break[(k_break > 0) == is_buy])
+            kb = kb[(kb > lo) & (kb < hi)]
+            k = np.sort(np.concatenate((np.geomspace(lo, hi, 17), kb, np.nextafter(kb, 0), np.nextafter(kb, np.inf))))
+            k_all.append(k if is_buy else -k[::-1])
+        px_all = calculate_perp_price_vec(k=np.concatenate(k_all), **amm_state)
+        # rounding noise in flat regions does not disable the index, the
+        # bound is widened by the tolerance instead
+        tol = 1e-12*abs(s["s2"])
+        bounds = dict()
+        for (is_buy, bucket), px in zip(buckets, np.split(px_all, np.cumsum([k.shape[0] for k in k_all])[:-1])):
+            dpx = np.diff(px)
+            if not np.all(np.isfinite(px)) or (np.any(dpx < -tol) and np.any(dpx > tol)):
+                bounds[(is_buy, bucket)] = None
+            else:
+                bounds[(is_buy, bucket)] = np.min(px) - tol if is_buy else np.max(px) + tol
+        return bounds
+
+    def _candidates(self, amm_state, mark_price):
+        cand = []
+        groups = [(key, group) for key, group in self.groups.items() if group.keys.shape[0] > 0]
+        if len(groups) == 0:
+            return np.zeros(0, dtype=np.int64)
+        bounds = self._bucket_bounds(amm_state, sorted({(is_buy, bucket) for (is_buy, _, bucket), _ in groups}))
+        for (is_buy, is_stop, bucket), group in groups:
+            px_best = bounds[(is_buy, bucket)]
+            if is_stop:
+                # stop buy: mark > trigger, stop sell: mark < trigger
+                if is_buy:
+                    idx = group.idx[:np.searchsorted(group.keys, mark_price, side="left")]
+                else:
+                    idx = group.idx[np.searchsorted(group.keys, mark_price, side="right"):]
+                # remove triggered orders with limit price that cannot be met
+                if px_best is None:
+                    pass
+                elif is_buy:
+                    idx = idx[self.limit_price[idx] >= px_best]
+                else:
+                    idx = idx[self.limit_price[idx] <= px_best]
+            elif px_best is None:
+                # price not monotone over the bucket: evaluate all orders
+                idx = group.idx
+            elif is_buy:
+                idx = group.idx[np.searchsorted(group.keys, px_best, side="left"):]
+            else:
+                idx = group.idx[:np.searchsorted(group.keys, px_best, side="right")]
+            cand.append(idx)
+        if len(cand) == 0:
+            return np.zeros(0, dtype=np.int64)
+        cand = np.concatenate(cand)
+        return cand[self.is_active[cand]]
+
+    def on_tick(self, amm_state, mark_price, trader_margin=None):
+        """Find all orders that are executable at the current AMM state
+
+        Each order is evaluated independently against the current AMM
+        state, i.e., the price impact of executing one order on the
+        other orders is not taken into account.
+
+        Args:
+            amm_state (dict): keyword arguments of calculate_perp_price_vec
+                except k (K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3,
+                minSpread)
+            mark_price (float): mark price used for stop orders
+            trader_margin (dict): optional, margin check after the trade
+                as in test_liquidations.is_margin_safe. Keys: pos,
+                LockedInValueQC, cashCC (arrays indexed by order id), S3,
+                markPremium, collateral_currency_index, marginrate
+
+        Returns:
+            (np.ndarray, np.ndarray): ids of executable orders and their
+                AMM fill prices
+        """
+        cand = self._candidates(amm_state, mark_price)
+        k = self.amount[cand]
+        px = calculate_perp_price_vec(k=k, **amm_state)
+        is_buy = k > 0
+        limit = self.limit_price[cand]
+        ok = np.where(is_buy, px <= limit, px >= limit)
+        if trader_margin is not None:
+            m = trader_margin
+            pos = m["pos"][cand] + k
+            L = m["LockedInValueQC"][cand] + k*px
+            ok = np.logical_and(ok, is_margin_safe(pos, L, m["cashCC"][cand], amm_state["s2"], m["S3"],
+                m["markPremium"], m["collateral_currency_index"], m["marginrate"]))
+        return cand[ok], px[ok]
+
+    def on_tick_full_scan(self, amm_state, mark_price):
+        # reference implementation without index, evaluates all orders
+        ids = np.arange(self.num_orders)[self.is_active[:self.num_orders]]
+        k = self.amount[ids]
+        px = calculate_perp_price_vec(k=k, **amm_state)
+        trig = self.trigger_price[ids]
+        limit = self.limit_price[ids]
+        is_buy = k > 0
+        ok = np.where(is_buy, px <= limit, px >= limit)
+        triggered = np.where(trig == 0, True, np.where(is_buy, mark_price > trig, mark_price < trig))
+        ok = np.logical_and(ok, triggered)
+        return ids[ok], px[ok]
+
+
+def test_trigger_engine():
+    # state as in test_pricing (no quanto)
+    amm_state = dict(K2=0.4, L1=0.4*36000, s2=38000, s3=2000, sig2=0.05, sig3=0.07,
+                     rho=0.5, r=0, M1=10, M2=0.06, M3=0, minSpread=0.0002)
+    rng = np.random.default_rng(1)
+    n = 500000
+    amount = rng.choice((-1, 1), n)*np.exp(rng.uniform(np.log(0.0001), np.log(2), n))
+    # mostly buy orders below and sell orders above the current price
+    limit_price = 38000*np.exp(-np.sign(amount)*rng.normal(0.05, 0.05, n))
+    trigger_price = np.where(rng.random(n) < 0.2, 38000*np.exp(rng.normal(0, 0.1, n)), 0)
+    engine = LimitOrderTriggerEngine()
+    t0 = time.time()
+    ids = engine.add_orders(amount, limit_price, trigger_price)
+    print("insert of", n, "orders: ", np.round(time.time()-t0, 3), "s")
+    t0 = time.time()
+    engine.cancel_orders(ids[::3])
+    print("cancel of", ids[::3].shape[0], "orders: ", np.round(time.time()-t0, 3), "s")
+    for s2 in (30000, 38000, 45000):
+        amm_state["s2"] = s2
+        mark_price = s2*1.001
+        t0 = time.time()
+        exe_ids, px = engine.on_tick(amm_state, mark_price)
+        t_idx = time.time()-t0
+        t0 = time.time()
+        exe_ids_ref, px_ref = engine.on_tick_full_scan(amm_state, mark_price)
+        t_scan = time.time()-t0
+        print("s2 =", s2, ": executable orders =", exe_ids.shape[0],
+              ", indexed", np.round(t_idx*1000, 2), "ms, full scan", np.round(t_scan*1000, 2), "ms")
+        assert(np.array_equal(np.sort(exe_ids), exe_ids_ref))
+
+    # random AMM states, including undercapitalised ones where the price is
+    # not monotone in the trade amount
+    num_states, n = 2000, 2000
+    states = sample_parameters(num_states, rng)
+    num_mismatch = 0
+    for j in range(num_states):
+        amm_state = {key: states[key][j] for key in ("K2", "L1", "s2", "s3", "sig2", "sig3", "rho", "r",
+                                                     "M1", "M2", "M3", "minSpread")}
+        px0 = calculate_perp_price_vec(k=0.0, **amm_state)
+        if not np.isfinite(px0):
+            continue
+        # amounts from far below to above the AMM exposure (and kStar)
+        amount = rng.choice((-1, 1), n)*np.abs(amm_state["K2"])*np.exp(rng.uniform(np.log(1e-3), np.log(4), n))
+        limit_price = px0*np.exp(-np.sign(amount)*rng.normal(0, 0.5, n))
+        trigger_price = np.where(rng.random(n) < 0.2, px0*np.exp(rng.normal(0, 0.1, n)), 0)
+        engine = LimitOrderTriggerEngine()
+        engine.add_orders(amount, limit_price, trigger_price)
+        exe_ids, _ = engine.on_tick(amm_state, px0)
+        exe_ids_ref, _ = engine.on_tick_full_scan(amm_state, px0)
+        num_mismatch += not np.array_equal(np.sort(exe_ids), exe_ids_ref)
+    print("random AMM states: ", num_states, ", on_tick != full scan:", num_mismatch)
+    assert(num_mismatch == 0)
+
+if __name__ == "__main__":
+    test_trigger_engine()
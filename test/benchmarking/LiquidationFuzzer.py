@@ -0,0 +1,316 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Property based fuzzer for the liquidation invariant of liquidation_test
+# in test_liquidations.py. Instead of two hand-picked configurations, millions
+# of random configurations are evaluated per run with the vectorized
+# functions of test_liquidations.py.
+#
+# Invariant, for accounts that are not maintenance margin safe:
+#   - the liquidation amount has the sign of the position and does not
+#     exceed the position
+#   - after the liquidation the position is closed or the margin balance
+#     covers the initial margin (required_balance <= b1 in liquidation_test)
+#
+# Failing configurations are shrunk to a minimal case (parameters set to
+# simple values or rounded to few significant digits as long as the case
+# still fails) and appended to FIXTURE_FILE. Saved fixtures are replayed
+# at the start of every run; the run fails while any of them still fails.
+#
+# usage: python LiquidationFuzzer.py [num_configs] [seed]
+
+import os
+import sys
+import json
+import time
+import numpy as np
+from test_liquidations import get_margin_rates, get_collateral_fx_vec, calculateLiquidationAmount_vec, \
+    get_margin_balance_cc_vec, is_margin_safe_vec, getBase2CollateralFX_vec, liquidation_test, \
+    calculateLiquidationAmount, get_margin_balance_cc, is_margin_safe, get_quote_to_collateral_fx, \
+    getBase2CollateralFX
+
+FIXTURE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "liquidation_counterexamples.json")
+
+PARAMS = ["traderPositionBC", "liquidationFee", "tradingFee", "lotSize", "S2_0", "S2", "S3",
+          "mark_premium", "cashCC", "collateral_currency_index", "fMaintenanceMarginRateAlpha",
+          "fInitialMarginRateAlpha", "fMarginRateBeta", "fInitialMarginRateCap"]
+
+# relative tolerance of the margin comparison (float noise is no counterexample)
+REL_TOL = 1e-9
+
+def sample_configurations(n, rng):
+    """Draw n random liquidation configurations
+
+    Args:
+        n (int): number of configurations
+        rng (np.random.Generator): random number generator
+
+    Returns:
+        dict: parameter name -> array of length n
+    """
+    p = dict()
+    p["lotSize"] = rng.choice((0.0001, 0.0002, 0.001, 0.01, 0.1), n)
+    pos = rng.choice((-1, 1), n)*np.exp(rng.uniform(np.log(1e-4), np.log(100), n))
+    p["traderPositionBC"] = np.sign(pos)*np.maximum(1, np.round(np.abs(pos)/p["lotSize"]))*p["lotSize"]
+    p["liquidationFee"] = rng.uniform(0, 0.05, n)
+    p["tradingFee"] = rng.uniform(0, 0.002, n)
+    p["S2_0"] = np.exp(rng.uniform(np.log(1), np.log(100000), n))
+    p["S2"] = p["S2_0"]*np.exp(rng.normal(0, 0.3, n))
+    p["S3"] = np.exp(rng.uniform(np.log(1), np.log(100000), n))
+    p["mark_premium"] = p["S2"]*rng.normal(0, 0.01, n)
+    p["collateral_currency_index"] = rng.integers(0, 3, n)
+    p["fMaintenanceMarginRateAlpha"] = rng.uniform(0.005, 0.1, n)
+    p["fInitialMarginRateAlpha"] = p["fMaintenanceMarginRateAlpha"] + rng.uniform(0, 0.05, n)
+    p["fMarginRateBeta"] = rng.uniform(0, 0.2, n)
+    p["fInitialMarginRateCap"] = rng.uniform(p["fInitialMarginRateAlpha"], 0.5)
+    # cash such that the margin balance is around the maintenance margin
+    mntnc_rate, _ = get_margin_rates(p["traderPositionBC"], p["fMaintenanceMarginRateAlpha"],
+        p["fInitialMarginRateAlpha"], p["fMarginRateBeta"], p["fInitialMarginRateCap"])
+    fx = get_collateral_fx_vec(p["S2"], p["S3"], p["collateral_currency_index"])
+    pnl_cc = p["traderPositionBC"]*(p["S2"] + p["mark_premium"] - p["S2_0"])/fx
+    b_target = np.abs(p["traderPositionBC"])*mntnc_rate*p["S2"]/fx*rng.uniform(-0.5, 1.5, n)
+    p["cashCC"] = b_target - pnl_cc
+    return p
+
+def evaluate(p):
+    """Liquidation of each configuration as in liquidation_test
+
+    Args:
+        p (dict): parameter name -> array; optional "mntnc_marginrate" and
+            "initialMarginRate" replace the rates of get_margin_rates
+
+    Returns:
+        (np.ndarray, dict): boolean array, True where the invariant is
+            violated, and intermediate results
+    """
+    pos = p["traderPositionBC"]
+    idx = p["collateral_currency_index"]
+    S2, S3, mark_premium, cashCC = p["S2"], p["S3"], p["mark_premium"], p["cashCC"]
+    mntnc_rate, initial_rate = get_margin_rates(pos, p["fMaintenanceMarginRateAlpha"],
+        p["fInitialMarginRateAlpha"], p["fMarginRateBeta"], p["fInitialMarginRateCap"])
+    mntnc_rate = p.get("mntnc_marginrate", mntnc_rate)
+    initial_rate = p.get("initialMarginRate", initial_rate)
+    fx = get_collateral_fx_vec(S2, S3, idx)
+    L = p["S2_0"]*pos
+    Sm = S2 + mark_premium
+    b0 = get_margin_balance_cc_vec(pos, L, S2, S3, mark_premium, cashCC, idx)
+    is_safe_before = is_margin_safe_vec(pos, L, cashCC, S2, S3, mark_premium, idx, mntnc_rate)
+    liq_amt = calculateLiquidationAmount_vec(S2, fx, b0, initial_rate, mntnc_rate, pos,
+        p["liquidationFee"], p["tradingFee"], p["lotSize"])
+    newPos = pos - liq_amt
+    newL = L - liq_amt * L/pos
+    newCashCC = cashCC - np.abs(liq_amt)*(p["tradingFee"]+p["liquidationFee"])*S2/fx + \
+        (liq_amt*Sm - L/pos * liq_amt)/fx
+    b1 = get_margin_balance_cc_vec(newPos, newL, S2, S3, mark_premium, newCashCC, idx)
+    required_balance = np.abs(newPos) * initial_rate * S2/fx
+    with np.errstate(invalid='ignore'):
+        wrong_amount = np.logical_or(np.abs(liq_amt) > np.abs(pos), liq_amt*pos < 0)
+        wrong_amount = np.logical_or(wrong_amount, ~np.isfinite(liq_amt))
+        not_safe_after = np.logical_and(newPos != 0,
+            required_balance > b1 + REL_TOL*np.maximum(np.abs(b1), required_balance))
+    failed = np.logical_and(~is_safe_before, np.logical_or(wrong_amount, not_safe_after))
+    res = {"b0": b0, "liq_amt": liq_amt, "b1": b1, "required_balance": required_balance,
+           "mntnc_marginrate": mntnc_rate, "initialMarginRate": initial_rate}
+    return failed, res
+
+def _simple_values(p):
+    # candidate values for shrinking, parameter name -> list of arrays
+    pos = p["traderPositionBC"]
+    zero = np.zeros_like(pos)
+    cand = {
+        "traderPositionBC": [np.sign(pos)*p["lotSize"], np.sign(pos)],
+        "liquidationFee": [zero],
+        "tradingFee": [zero],
+        "lotSize": [zero + 0.0001],
+        "S2_0": [p["S2"]],
+        "S3": [p["S2"], zero + 1],
+        "mark_premium": [zero],
+        "collateral_currency_index": [zero + 1, zero],
+        "fMarginRateBeta": [zero],
+        "fInitialMarginRateAlpha": [p["fMaintenanceMarginRateAlpha"]],
+        "fInitialMarginRateCap": [np.maximum(p["fInitialMarginRateAlpha"], 0.5)],
+    }
+    # rounding to few significant digits
+    for name in PARAMS:
+        x = p[name]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mag = 10.0**np.floor(np.log10(np.abs(x)))
+        mag = np.where(np.isfinite(mag) & (mag > 0), mag, 1)
+        cand.setdefault(name, [])
+        cand[name] = cand[name] + [np.round(x/mag, d)*mag for d in (0, 1, 2, 4)]
+    return cand
+
+def _cost(p):
+    # complexity of a configuration: number of significant digits and non-simple values
+    c = 0
+    for name in PARAMS:
+        x = np.abs(p[name])
+        digits = np.array([len(("%.12g" % v).replace("-", "").replace(".", "").strip("0")) for v in x])
+        c = c + digits + (x != 0)
+    return c
+
+def shrink(p, max_rounds=50):
+    """Shrink failing configurations to minimal failing configurations
+
+    All failing configurations are shrunk simultaneously: in each round all
+    candidate simplifications are evaluated in one vectorized batch and for
+    each configuration the simplest candidate that still fails is kept.
+
+    Args:
+        p (dict): failing configurations, parameter name -> array
+        max_rounds (int): maximal number of shrinking rounds
+
+    Returns:
+        dict: shrunk configurations
+    """
+    p = {name: np.array(p[name], dtype=float) for name in PARAMS}
+    n = p["S2"].shape[0]
+    for _ in range(max_rounds):
+        cand = _simple_values(p)
+        variants = []
+        for name in PARAMS:
+            for values in cand.get(name, []):
+                v = {key: p[key].copy() for key in PARAMS}
+                v[name] = values
+                if name == "fMaintenanceMarginRateAlpha":
+                    v["fInitialMarginRateAlpha"] = np.maximum(v["fInitialMarginRateAlpha"], values)
+                variants.append(v)
+        batch = {name: np.concatenate([v[name] for v in variants]) for name in PARAMS}
+        failed, _ = evaluate(batch)
+        cost = np.where(failed, _cost(batch), np.inf).reshape(len(variants), n)
+        best = np.argmin(cost, axis=0)
+        improved = cost[best, np.arange(n)] < _cost(p)
+        if not np.any(improved):
+            break
+        for name in PARAMS:
+            new = batch[name].reshape(len(variants), n)[best, np.arange(n)]
+            p[name] = np.where(improved, new, p[name])
+    return p
+
+def load_fixtures(filename=FIXTURE_FILE):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        rows = json.load(f)
+    if len(rows) == 0:
+        return None
+    return {name: np.array([row[name] for row in rows], dtype=float) for name in PARAMS}
+
+def save_fixtures(p, filename=FIXTURE_FILE, seed=None):
+    """Append configurations to the regression fixtures (json list)"""
+    rows = []
+    if os.path.exists(filename):
+        with open(filename) as f:
+            rows = json.load(f)
+    known = set(json.dumps([row[name] for name in PARAMS]) for row in rows)
+    for j in range(p["S2"].shape[0]):
+        row = {name: float(p[name][j]) for name in PARAMS}
+        key = json.dumps([row[name] for name in PARAMS])
+        if key not in known:
+            known.add(key)
+            row["seed"] = seed
+            rows.append(row)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(rows, f, indent=1)
+    return len(rows)
+
+def fuzz(num_configs, seed=0, chunk_size=1000000, max_shrink=100):
+    """Run the fuzzer
+
+    Args:
+        num_configs (int): number of random configurations
+        seed (int): random seed
+        chunk_size (int): configurations evaluated per batch
+        max_shrink (int): maximal number of failures that are shrunk and saved
+
+    Returns:
+        dict: shrunk failing configurations (empty arrays if none)
+    """
+    rng = np.random.default_rng(seed)
+    fixtures = load_fixtures()
+    if fixtures is not None:
+        failed, _ = evaluate(fixtures)
+        print("replayed", failed.shape[0], "fixtures,", int(np.sum(failed)), "still failing")
+        assert(not np.any(failed)), "saved counterexamples in " + FIXTURE_FILE + " still fail"
+    failures = {name: [] for name in PARAMS}
+    num_failed, num_unsafe, done = 0, 0, 0
+    t0 = time.time()
+    while done < num_configs:
+        n = min(chunk_size, num_configs - done)
+        p = sample_configurations(n, rng)
+        failed, res = evaluate(p)
+        num_unsafe += int(np.sum(res["liq_amt"] != 0))
+        num_failed += int(np.sum(failed))
+        for name in PARAMS:
+            failures[name].append(p[name][failed])
+        done += n
+    print("evaluated", done, "configurations (", num_unsafe, "liquidations ) in",
+          np.round(time.time()-t0, 2), "s,", num_failed, "failures")
+    failures = {name: np.concatenate(failures[name])[:max_shrink] for name in PARAMS}
+    if failures["S2"].shape[0] > 0:
+        failures = shrink(failures)
+        num_saved = save_fixtures(failures, seed=seed)
+        print("shrunk failures saved to", FIXTURE_FILE, "(", num_saved, "fixtures )")
+    return failures
+
+def test_vectorized_vs_liquidation_test():
+    # the two configurations of liquidation_test in test_liquidations.py: fixed
+    # margin rates 0.10/0.15, then the rates of get_margin_rates
+    p = {"traderPositionBC": np.array([-1., -1.]), "liquidationFee": np.array([0.05, 0.002]),
+         "tradingFee": np.array([0.0008, 0.0006]), "lotSize": np.array([0.0002, 0.0002]),
+         "S2_0": np.array([35000., 35000.]), "S2": np.array([60000., 60000.]),
+         "S3": np.array([60000., 60000.]), "mark_premium": np.array([1000., 1000.]),
+         "cashCC": np.array([0.5, 0.5]), "collateral_currency_index": np.array([1, 1]),
+         "fMaintenanceMarginRateAlpha": np.array([0.04, 0.04]), "fInitialMarginRateAlpha": np.array([0.06, 0.06]),
+         "fMarginRateBeta": np.array([0.10, 0.10]), "fInitialMarginRateCap": np.array([0.10, 0.10])}
+    mntnc_rate, initial_rate = get_margin_rates(-1., 0.04, 0.06, 0.10, 0.10)
+    p["mntnc_marginrate"] = np.array([0.10, mntnc_rate])
+    p["initialMarginRate"] = np.array([0.15, initial_rate])
+    failed, res = evaluate(p)
+    assert(not np.any(failed))
+    for j in range(2):
+        expected = liquidation_test(p["traderPositionBC"][j], p["liquidationFee"][j], p["tradingFee"][j],
+                                    p["lotSize"][j], p["S2_0"][j], p["cashCC"][j], p["S2"][j],
+                                    p["mark_premium"][j], p["mntnc_marginrate"][j], p["initialMarginRate"][j])
+        got = [res[name][j] for name in ("b0", "liq_amt", "b1", "required_balance")]
+        assert(np.allclose(got, expected, rtol=1e-12, atol=1e-12))
+    assert(np.abs(res["liq_amt"][1] - (-0.3424)) < 1e-12)
+
+def test_vectorized_vs_scalar(n=3000, seed=0):
+    # vectorized ports against the scalar functions of test_liquidations.py, all collateral currencies
+    p = sample_configurations(n, np.random.default_rng(seed))
+    pos, idx, S2, S3 = p["traderPositionBC"], p["collateral_currency_index"], p["S2"], p["S3"]
+    mntnc_rate, initial_rate = get_margin_rates(pos, p["fMaintenanceMarginRateAlpha"],
+        p["fInitialMarginRateAlpha"], p["fMarginRateBeta"], p["fInitialMarginRateCap"])
+    L = p["S2_0"]*pos
+    fx = get_collateral_fx_vec(S2, S3, idx)
+    b2c = getBase2CollateralFX_vec(S2, S3, p["mark_premium"], idx, False)
+    b0 = get_margin_balance_cc_vec(pos, L, S2, S3, p["mark_premium"], p["cashCC"], idx)
+    safe = is_margin_safe_vec(pos, L, p["cashCC"], S2, S3, p["mark_premium"], idx, mntnc_rate)
+    liq_amt = calculateLiquidationAmount_vec(S2, fx, b0, initial_rate, mntnc_rate, pos,
+        p["liquidationFee"], p["tradingFee"], p["lotSize"])
+    assert(set(idx.tolist()) == {0, 1, 2} and np.any(liq_amt != 0) and np.any(liq_amt == 0))
+    for j in range(n):
+        c = int(idx[j])
+        assert(np.isclose(fx[j], 1/get_quote_to_collateral_fx(S2[j], S3[j], c), rtol=1e-14, atol=0))
+        assert(np.isclose(b2c[j], getBase2CollateralFX(S2[j], S3[j], p["mark_premium"][j], c, False),
+                          rtol=1e-14, atol=0))
+        b0_j = get_margin_balance_cc(pos[j], L[j], S2[j], S3[j], p["mark_premium"][j], p["cashCC"][j], c)
+        assert(np.isclose(b0[j], b0_j, rtol=1e-12, atol=1e-12*np.abs(pos[j]*S2[j]/fx[j])))
+        assert(safe[j] == is_margin_safe(pos[j], L[j], p["cashCC"][j], S2[j], S3[j], p["mark_premium"][j], c,
+                                         mntnc_rate[j]))
+        amt = calculateLiquidationAmount(S2[j], fx[j], b0[j], initial_rate[j], mntnc_rate[j], pos[j],
+                                         p["liquidationFee"][j], p["tradingFee"][j], p["lotSize"][j])
+        assert(liq_amt[j] == amt)
+
+if __name__ == "__main__":
+    num_configs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else int(time.time())
+    # printed first so that crashed or interrupted runs can be repeated
+    print("seed =", seed, "(rerun: python LiquidationFuzzer.py", num_configs, str(seed) + ")", flush=True)
+    test_vectorized_vs_liquidation_test()
+    test_vectorized_vs_scalar()
+    failures = fuzz(num_configs, seed)
+    for j in range(min(5, failures["S2"].shape[0])):
+        print({name: float(failures[name][j]) for name in PARAMS})
@@ -0,0 +1,249 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Keeper liquidation planner: which unsafe accounts to liquidate first and
+# how to batch the liquidations into transactions.
+#
+# For all accounts (vectorized):
+#   - liquidation amount as calculateLiquidationAmount_vec (target: initial
+#     margin rate, get_margin_rates), 0 for maintenance margin safe accounts
+#   - keeper reward as in PerpetualLiquidator._payLiquidationPenalty: half of
+#     the penalty |amount|*B2C*liquidationFee, the penalty capped at the
+#     remaining margin (margin balance - maintenance margin of the remaining
+#     position). Rewards are compared in quote currency (reward_cc * S3)
+#   - price impact: the liquidation is a trade of -amount against the AMM,
+#     calculate_perp_price(K2, -amount, L1, ..., minSpread=0)/S2 - 1 at the
+#     AMM state left by the liquidations before it in the same perpetual
+#
+# Per perpetual the candidates are ordered by reward and accepted greedily
+# in this order; a candidate with |impact| > max_price_impact at the current
+# AMM state is deferred to a later plan. The AMM states along the order are
+# cumulative sums of the accepted trades, so a window of candidates is
+# evaluated in one vectorized call: the candidates before the first
+# violation are accepted, and a run of violations is deferred at once as the
+# state does not change while candidates are deferred. The
+# per-perpetual sequences are merged with a heap by reward (the order within
+# a perpetual is kept, the impacts depend on it) and cut into transactions of
+# max_liquidations_per_tx. Liquidations with a reward below their gas cost
+# and transactions with a total reward below their gas cost are dropped, so
+# every emitted transaction has the maximal reward possible at its position.
+#
+# Account store (dict of arrays): perp, pos, L, cash (as PoolSettlement.py)
+# Perpetuals (dict of arrays, one entry per perpetual):
+#   S2, S3, mark_premium, collateral_currency_index,
+#   AMM state K2, L1, M1, M2, M3, sig2, sig3, rho, r (as calculate_perp_price,
+#   K2 is minus the AMM position, i.e. the net position of the traders),
+#   liquidationFee, tradingFee, lotSize, fMaintenanceMarginRateAlpha,
+#   fInitialMarginRateAlpha, fMarginRateBeta, fInitialMarginRateCap
+#
+# usage: python LiquidationPlanner.py [num_accounts] [num_perpetuals]
+
+import sys
+import time
+import heapq
+import numpy as np
+from PricingBenchmark import calculate_perp_price_vec
+from test_liquidations import get_margin_rates, get_collateral_fx_vec, getBase2CollateralFX_vec, \
+    calculateLiquidationAmount_vec, get_margin_balance_cc_vec
+
+AMM_STATE = ("K2", "L1", "M1", "M2", "M3", "sig2", "sig3", "rho", "r")
+# initial number of candidates evaluated per vectorized step, the window
+# doubles while all candidates of a window pass
+MIN_WINDOW = 64
+
+def _at(perps, name, p):
+    return np.asarray(perps[name])[p]
+
+def liquidation_candidates(accounts, perps):
+    """Liquidation amount and keeper reward of every account
+
+    Returns:
+        dict: amount (base currency, sign of the position, 0 if safe),
+            reward_cc (keeper reward in collateral currency) and
+            reward_qc (in quote currency) per account
+    """
+    p = accounts["perp"]
+    pos = accounts["pos"]
+    S2, S3, premium = _at(perps, "S2", p), _at(perps, "S3", p), _at(perps, "mark_premium", p)
+    cc_idx = _at(perps, "collateral_currency_index", p)
+    fx = get_collateral_fx_vec(S2, S3, cc_idx)
+    mntnc, initial = get_margin_rates(pos, _at(perps, "fMaintenanceMarginRateAlpha", p),
+        _at(perps, "fInitialMarginRateAlpha", p), _at(perps, "fMarginRateBeta", p),
+        _at(perps, "fInitialMarginRateCap", p))
+    margin = get_margin_balance_cc_vec(pos, accounts["L"], S2, S3, premium, accounts["cash"], cc_idx)
+    liq_fee = _at(perps, "liquidationFee", p)
+    amount = calculateLiquidationAmount_vec(S2, fx, margin, initial, mntnc, pos, liq_fee,
+                                            _at(perps, "tradingFee", p), _at(perps, "lotSize", p))
+    b2c = getBase2CollateralFX_vec(S2, S3, premium, cc_idx, False)
+    remaining = np.maximum(margin - np.abs(pos - amount)*mntnc*b2c, 0)
+    reward_cc = 0.5*np.minimum(np.abs(amount)*b2c*liq_fee, remaining)
+    return {"amount": amount, "reward_cc": reward_cc, "reward_qc": reward_cc*fx}
+
+def _impacts(perps, p, K2, L1, dK2, k):
+    # AMM price of the trades k at the states K2+dK2, L1+dK2*S2 relative to S2, minus 1
+    s2 = perps["S2"][p]
+    price = calculate_perp_price_vec(K2 + dK2, k, L1 + dK2*s2, s2, perps["S3"][p], perps["sig2"][p],
+        perps["sig3"][p], perps["rho"][p], perps["r"][p], perps["M1"][p], perps["M2"][p], perps["M3"][p], 0)
+    return price/s2 - 1
+
+def sequential_impacts(perps, p, k):
+    """Price impacts of the trades k (in this order) against the AMM of perpetual p
+
+    Returns:
+        np.ndarray: AMM price of each trade relative to S2, minus 1
+    """
+    return _impacts(perps, p, perps["K2"][p], perps["L1"][p], np.cumsum(k) - k, k)
+
+def plan_liquidations(accounts, perps, max_price_impact=0.01, max_liquidations_per_tx=20,
+                      tx_cost_qc=0.0, liquidation_cost_qc=0.0):
+    """Rank unsafe accounts and batch their liquidations
+
+    Args:
+        accounts (dict): account store, arrays perp, pos, L, cash
+        perps (dict): perpetual data, see module description
+        max_price_impact (float): maximal |AMM price/S2 - 1| of a liquidation
+        max_liquidations_per_tx (int): liquidations per transaction
+        tx_cost_qc (float): gas cost of a transaction in quote currency
+        liquidation_cost_qc (float): gas cost per liquidation in quote currency
+
+    Returns:
+        dict: batches (list of arrays of account indices, in execution
+            order), amount, reward_qc and impact per account (impact nan if
+            not planned), deferred (indices deferred because of the price
+            impact), unprofitable (indices with reward below the gas cost)
+    """
+    cand = liquidation_candidates(accounts, perps)
+    amount, reward = cand["amount"], cand["reward_qc"]
+    impact = np.full(amount.shape[0], np.nan)
+    unsafe = np.nonzero(amount != 0)[0]
+    is_profitable = reward[unsafe] > liquidation_cost_qc
+    unprofitable = unsafe[~is_profitable]
+    unsafe = unsafe[is_profitable]
+    deferred = []
+    sequences = []
+    perp_of = accounts["perp"][unsafe]
+    order = np.lexsort((-reward[unsafe], perp_of))
+    unsafe, perp_of = unsafe[order], perp_of[order]
+    bounds = np.searchsorted(perp_of, np.arange(perps["S2"].shape[0]+1))
+    for p in range(perps["S2"].shape[0]):
+        idx = unsafe[bounds[p]:bounds[p+1]]
+        k = -amount[idx]
+        K2, L1 = float(perps["K2"][p]), float(perps["L1"][p])
+        is_accepted = np.zeros(idx.shape[0], dtype=bool)
+        start, w = 0, MIN_WINDOW
+        while start < idx.shape[0]:
+            kw = k[start:start+w]
+            # candidates exceeding the bound at the current state are deferred,
+            # the state does not change while they are deferred
+            ok = np.abs(_impacts(perps, p, K2, L1, np.zeros(kw.shape[0]), kw)) <= max_price_impact
+            num_deferred = np.argmax(ok) if np.any(ok) else kw.shape[0]
+            if num_deferred > 0:
+                start += num_deferred
+                w = 2*w if num_deferred == kw.shape[0] else w
+                continue
+            # accept until the first violation at the states of the accepted trades
+            imp = _impacts(perps, p, K2, L1, np.cumsum(kw) - kw, kw)
+            bad = np.nonzero(np.abs(imp) > max_price_impact)[0]
+            num_ok = bad[0] if bad.shape[0] > 0 else kw.shape[0]
+            impact[idx[start:start+num_ok]] = imp[:num_ok]
+            is_accepted[start:start+num_ok] = True
+            K2 += np.sum(kw[:num_ok])
+            L1 += np.sum(kw[:num_ok])*perps["S2"][p]
+            start += num_ok
+            w = 2*w if num_ok == kw.shape[0] else max(MIN_WINDOW, w//2)
+        deferred.append(idx[~is_accepted])
+        if np.any(is_accepted):
+            sequences.append(idx[is_accepted])
+    # merge by reward, keeping the order within each perpetual
+    merged = heapq.merge(*[[(-reward[j], j) for j in seq.tolist()] for seq in sequences])
+    ranked = np.array([j for _, j in merged], dtype=np.int64)
+    batches = []
+    for start in range(0, ranked.shape[0], max_liquidations_per_tx):
+        batch = ranked[start:start+max_liquidations_per_tx]
+        if np.sum(reward[batch]) - liquidation_cost_qc*batch.shape[0] <= tx_cost_qc:
+            # later batches have lower rewards
+            break
+        batches.append(batch)
+    deferred = np.concatenate(deferred) if len(deferred) > 0 else np.zeros(0, dtype=np.int64)
+    return {"batches": batches, "amount": amount, "reward_qc": reward, "impact": impact,
+            "deferred": deferred, "unprofitable": unprofitable}
+
+def random_unsafe_accounts(num_accounts, num_perps, rng):
+    """Random accounts after a price move, with AMMs as counterparty"""
+    S2_0 = np.exp(rng.uniform(np.log(10), np.log(50000), num_perps))
+    perps = {"S2": S2_0*np.exp(rng.normal(0, 0.08, num_perps)),
+             "collateral_currency_index": np.full(num_perps, rng.choice((0, 2)))}
+    perps["S3"] = np.full(num_perps, np.exp(rng.uniform(np.log(10), np.log(50000))))
+    perps["mark_premium"] = perps["S2"]*rng.normal(0, 0.002, num_perps)
+    for name, value in (("liquidationFee", 0.005), ("tradingFee", 0.0008), ("lotSize", 0.0001),
+                        ("fMaintenanceMarginRateAlpha", 0.04), ("fInitialMarginRateAlpha", 0.06),
+                        ("fMarginRateBeta", 0.1), ("fInitialMarginRateCap", 0.1),
+                        ("M1", 0), ("M3", 0), ("sig3", 0), ("rho", 0), ("r", 0)):
+        perps[name] = np.full(num_perps, value, dtype=float)
+    perps["sig2"] = rng.uniform(0.03, 0.08, num_perps)
+    fx = get_collateral_fx_vec(perps["S2"], perps["S3"], perps["collateral_currency_index"])
+    perp = rng.integers(0, num_perps, num_accounts)
+    pos = rng.normal(0, 1, num_accounts)
+    entry = S2_0[perp]*np.exp(rng.normal(0, 0.02, num_accounts))
+    accounts = {"perp": perp, "pos": pos, "L": pos*entry,
+                "cash": np.abs(pos)*S2_0[perp]/fx[perp]*rng.uniform(0.05, 0.2, num_accounts)}
+    # the AMM holds the opposite of the trader positions: K2 (minus the AMM
+    # position) is the net trader position; cash for a moderate default probability
+    perps["K2"] = np.bincount(perp, weights=pos, minlength=num_perps)
+    perps["L1"] = perps["K2"]*S2_0
+    perps["M2"] = np.abs(perps["K2"])*0.5
+    return accounts, perps
+
+def test_plan_vs_sequential():
+    # replay the plan one liquidation at a time with the scalar functions
+    from PricingBenchmark import calculate_perp_price
+    from test_liquidations import calculateLiquidationAmount, get_margin_balance_cc
+    rng = np.random.default_rng(3)
+    accounts, perps = random_unsafe_accounts(3000, 3, rng)
+    res = plan_liquidations(accounts, perps, max_price_impact=0.005, max_liquidations_per_tx=7)
+    state = {name: np.array(perps[name], dtype=float) for name in AMM_STATE}
+    rewards = dict()
+    for batch in res["batches"]:
+        assert(batch.shape[0] <= 7)
+        for j in batch:
+            p = accounts["perp"][j]
+            S2, S3 = perps["S2"][p], perps["S3"][p]
+            cc_idx = perps["collateral_currency_index"][p]
+            fx = 1 if cc_idx == 0 else S3
+            pos = accounts["pos"][j]
+            mntnc, initial = get_margin_rates(pos, 0.04, 0.06, 0.1, 0.1)
+            margin = get_margin_balance_cc(pos, accounts["L"][j], S2, S3, perps["mark_premium"][p],
+                                           accounts["cash"][j], cc_idx)
+            amt = calculateLiquidationAmount(S2, fx, margin, initial, mntnc, pos, 0.005, 0.0008, 0.0001)
+            assert(np.abs(amt - res["amount"][j]) <= 1e-9*np.abs(amt))
+            k = -res["amount"][j]
+            px = calculate_perp_price(state["K2"][p], k, state["L1"][p], S2, S3, state["sig2"][p],
+                state["sig3"][p], state["rho"][p], state["r"][p], state["M1"][p], state["M2"][p], state["M3"][p], 0)
+            assert(np.abs(px/S2 - 1 - res["impact"][j]) < 1e-9)
+            assert(np.abs(px/S2 - 1) <= 0.005)
+            state["K2"][p] += k
+            state["L1"][p] += k*S2
+            rewards.setdefault(p, []).append(res["reward_qc"][j])
+    # decreasing rewards within each perpetual, some liquidations deferred
+    for p in rewards:
+        assert(np.all(np.diff(rewards[p]) <= 0))
+    assert(len(rewards) > 0 and res["deferred"].shape[0] > 0)
+
+if __name__ == "__main__":
+    num_accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    num_perps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    test_plan_vs_sequential()
+    accounts, perps = random_unsafe_accounts(num_accounts, num_perps, np.random.default_rng(0))
+    t0 = time.time()
+    res = plan_liquidations(accounts, perps, max_price_impact=0.01, max_liquidations_per_tx=20,
+                            tx_cost_qc=1.0, liquidation_cost_qc=0.2)
+    duration = time.time()-t0
+    num_planned = sum(b.shape[0] for b in res["batches"])
+    print("accounts:", num_accounts, ", unsafe:", np.sum(res["amount"] != 0), ", planned:", num_planned,
+          "in", len(res["batches"]), "transactions, deferred (price impact):", res["deferred"].shape[0],
+          ", unprofitable:", res["unprofitable"].shape[0])
+    print("planning time:", np.round(duration, 3), "s")
+    if len(res["batches"]) > 0:
+        tx_rewards = np.array([np.sum(res["reward_qc"][b]) for b in res["batches"]])
+        print("reward per transaction: first", np.round(tx_rewards[0], 2), ", last", np.round(tx_rewards[-1], 2),
+              ", total", np.round(np.sum(tx_rewards), 2))
@@ -0,0 +1,150 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Optional integer lot representation of positions and trade amounts.
+#
+# Positions and trade amounts are stored as int64 numbers of lots
+# (amount = lots*lotSize). Sums of positions are exact and the results do
+# not depend on the order of the additions. The entry points below convert
+# at the boundary to the float functions of test_liquidations.py and
+# PricingBenchmark.py.
+#
+# Rounding of a float amount x to lots (x/lotSize is first snapped to the
+# nearest integer if it is within SNAP_ULPS units in the last place of it,
+# the rounding error of the division, so that e.g.
+# 0.0006/0.0002 = 2.9999999999999996 counts as exactly 3 lots):
+#   ROUND_UP:      away from zero (|lots| >= |x|/lotSize), as growToLot
+#   ROUND_DOWN:    towards zero (|lots| <= |x|/lotSize)
+#   ROUND_NEAREST: nearest lot, halves away from zero
+# Note: grow_to_lot in test_liquidations.py adds a lot also to exact
+# multiples of the lot size (int(abs/lot+1)), ROUND_UP does not.
+
+import numpy as np
+from test_liquidations import calculateLiquidationAmount_vec, get_margin_balance_cc_vec, \
+    is_margin_safe_vec
+
+ROUND_UP = "up"
+ROUND_DOWN = "down"
+ROUND_NEAREST = "nearest"
+
+# value/lotSize within SNAP_ULPS*eps*|value/lotSize| of an integer is that integer
+SNAP_ULPS = 8
+
+def to_lots(value, lotSize, rounding=ROUND_UP):
+    """Convert amounts to int64 lot counts
+
+    Args:
+        value (array): amounts in base currency
+        lotSize (float or array): lot size
+        rounding (str): ROUND_UP, ROUND_DOWN or ROUND_NEAREST
+
+    Returns:
+        np.ndarray: number of lots (int64)
+    """
+    x = np.asarray(value, dtype=float)/lotSize
+    n = np.rint(x)
+    x = np.where(np.abs(x - n) <= SNAP_ULPS*np.finfo(float).eps*np.abs(x), n, x)
+    a = np.abs(x)
+    if rounding == ROUND_UP:
+        a = np.ceil(a)
+    elif rounding == ROUND_DOWN:
+        a = np.floor(a)
+    elif rounding == ROUND_NEAREST:
+        a = np.floor(a + 0.5)
+    else:
+        raise ValueError("unknown rounding " + str(rounding))
+    return (np.sign(x)*a).astype(np.int64)
+
+def from_lots(lots, lotSize):
+    """Convert int64 lot counts to amounts in base currency"""
+    return np.asarray(lots)*lotSize
+
+def calculateLiquidationAmount_lots(S2, S3, margin_balance, targetMarginRate, maintMarginRate, traderPositionLots,
+                                    liquidationFee, tradingFee, lotSize):
+    """calculateLiquidationAmount with the position and the result in lots
+
+    S3 is the value of one unit of collateral in quote currency, as in
+    calculateLiquidationAmount. The liquidation amount is rounded up to
+    lots (growToLot) and capped at the position in exact integer arithmetic.
+
+    Returns:
+        np.ndarray: liquidation amount in lots (int64)
+    """
+    pos_lots = np.asarray(traderPositionLots, dtype=np.int64)
+    pos = from_lots(pos_lots, lotSize)
+    f = (liquidationFee+tradingFee)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trade_amt = (np.abs(pos)*targetMarginRate -  margin_balance *S3/S2) / \
+            ( np.sign(pos) * (targetMarginRate - f) )
+    # a non-finite amount (targetMarginRate == f) liquidates the whole position
+    finite = np.isfinite(trade_amt)
+    trade_lots = to_lots(np.where(finite, trade_amt, 0), lotSize, ROUND_UP)
+    trade_lots = np.where(finite & (np.abs(trade_lots) < np.abs(pos_lots)), trade_lots, pos_lots)
+    trade_lots = np.where(margin_balance > np.abs(pos) * f * S2/S3, trade_lots, pos_lots)
+    is_safe = margin_balance * S3 / S2 > maintMarginRate*np.abs(pos)
+    return np.where(is_safe, 0, trade_lots).astype(np.int64)
+
+def get_margin_balance_cc_lots(pos_lots, lotSize, LockedInValueQC, S2, S3, markPremium, cashCC, collateral_currency_index):
+    return get_margin_balance_cc_vec(from_lots(pos_lots, lotSize), LockedInValueQC, S2, S3, markPremium, cashCC,
+                                     collateral_currency_index)
+
+def is_margin_safe_lots(pos_lots, lotSize, LockedInValueQC, cashCC, S2, S3, markPremium, collateral_currency_index, marginrate):
+    return is_margin_safe_vec(from_lots(pos_lots, lotSize), LockedInValueQC, cashCC, S2, S3, markPremium,
+                              collateral_currency_index, marginrate)
+
+def calculate_perp_price_lots(K2_lots, k_lots, lotSize, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread=0.0001):
+    """calculate_perp_price with the AMM position K2 and the trade amount k in lots"""
+    # imported here: PricingBenchmark pulls in matplotlib
+    from PricingBenchmark import calculate_perp_price_vec
+    return calculate_perp_price_vec(from_lots(K2_lots, lotSize), from_lots(k_lots, lotSize), L1, s2, s3,
+                                    sig2, sig3, rho, r, M1, M2, M3, minSpread)
+
+def test_rounding():
+    lot = 0.0002
+    x = np.array([0.0006, -0.0006, 0.00061, -0.00061, 0.0007, -0.0007, 0.00069, 0])
+    assert(np.array_equal(to_lots(x, lot, ROUND_UP), [3, -3, 4, -4, 4, -4, 4, 0]))
+    assert(np.array_equal(to_lots(x, lot, ROUND_DOWN), [3, -3, 3, -3, 3, -3, 3, 0]))
+    assert(np.array_equal(to_lots(x, lot, ROUND_NEAREST), [3, -3, 3, -3, 4, -4, 3, 0]))
+    # large lot counts: fractions of a lot are not snapped away
+    x = np.array([50000.00004, -50000.00004, 50000.0, 50000.0001, 0.1+0.2])
+    assert(np.array_equal(to_lots(x, 0.0001, ROUND_UP), [500000001, -500000001, 500000000, 500000001, 3000]))
+    assert(np.array_equal(to_lots(x, 0.0001, ROUND_DOWN), [500000000, -500000000, 500000000, 500000001, 3000]))
+    n = np.arange(1, 10**6)*997
+    assert(np.array_equal(to_lots(n*0.0001, 0.0001, ROUND_UP), n))
+    assert(np.array_equal(to_lots(n*0.0001 + 0.00005, 0.0001, ROUND_DOWN), n))
+
+def test_sum_of_trades():
+    # 10000 trades of one lot: float sum drifts, lot sum is exact
+    lot = 0.0002
+    trades = np.full(10000, lot)
+    pos_float = 0.0
+    for k in trades:
+        pos_float += k
+    pos_lots = np.sum(to_lots(trades, lot))
+    print("float position =", repr(float(pos_float)), ", lot position =", pos_lots, "lots =", repr(float(from_lots(pos_lots, lot))))
+    assert(pos_lots == 10000)
+
+def test_liquidation_lots_vs_float():
+    # same liquidation amounts as calculateLiquidationAmount_vec where the
+    # float lot rounding is not affected by representation errors
+    rng = np.random.default_rng(11)
+    n = 1000000
+    lot = rng.choice((0.0001, 0.0002, 0.001), n)
+    pos_lots = rng.choice((-1, 1), n)*rng.integers(1, 100000, n)
+    pos = from_lots(pos_lots, lot)
+    S2 = np.exp(rng.uniform(np.log(10), np.log(50000), n))
+    S3 = S2
+    mntnc, target = 0.04 + 0.1*rng.random(n), 0.15 + 0.1*rng.random(n)
+    margin = np.abs(pos)*mntnc*rng.uniform(0, 1.2, n)
+    liqFee, tradingFee = 0.002, 0.0006
+    liq_lots = calculateLiquidationAmount_lots(S2, S3, margin, target, mntnc, pos_lots, liqFee, tradingFee, lot)
+    liq = calculateLiquidationAmount_vec(S2, S3, margin, target, mntnc, pos, liqFee, tradingFee, lot)
+    diff = to_lots(liq, lot, ROUND_NEAREST) - liq_lots
+    print("liquidation amounts differing from float version:", np.sum(diff != 0), "of", n)
+    # the float version can only differ by one lot (ceil of a value just off an integer)
+    assert(np.all((diff == 0) | (np.abs(diff) == 1)))
+
+if __name__ == "__main__":
+    test_rounding()
+    test_sum_of_trades()
+    test_liquidation_lots_vs_float()
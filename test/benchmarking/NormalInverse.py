@@ -0,0 +1,190 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Vectorized inverse of the standard normal cdf without scipy, for target
+# distance to default (dd = Phi^-1(pd)) and liquidation probability
+# computations.
+#
+#   norm_ppf:        Wichura, Algorithm AS241 (PPND16), rational
+#                    approximations in three regions. Max relative error
+#                    vs scipy.stats.norm.ppf over p in [1e-9, 0.5]:
+#                    < 1e-15 (measured, see __main__)
+#   norm_ppf_acklam: P. J. Acklam's rational approximation, cheaper.
+#                    Max relative error 1.15e-9; with polish=True one
+#                    Halley step (uses scipy.special.ndtr) brings it to
+#                    about 1e-13
+#
+# Both return -inf/inf for p = 0/1 and nan outside [0, 1]; p > 0.5 is
+# computed by symmetry.
+#
+# usage: python NormalInverse.py [num_points]
+#   error and speed benchmark against scipy.stats.norm.ppf
+
+import sys
+import math
+import time
+import numpy as np
+
+# AS241 coefficients, highest order first
+_A = (2.5090809287301226727e+3, 3.3430575583588128105e+4, 6.7265770927008700853e+4, 4.5921953931549871457e+4,
+      1.3731693765509461125e+4, 1.9715909503065514427e+3, 1.3314166789178437745e+2, 3.3871328727963666080e0)
+_B = (5.2264952788528545610e+3, 2.8729085735721942674e+4, 3.9307895800092710610e+4, 2.1213794301586595867e+4,
+      5.3941960214247511077e+3, 6.8718700749205790830e+2, 4.2313330701600911252e+1, 1.0)
+_C = (7.74545014278341407640e-4, 2.27238449892691845833e-2, 2.41780725177450611770e-1, 1.27045825245236838258e0,
+      3.64784832476320460504e0, 5.76949722146069140550e0, 4.63033784615654529590e0, 1.42343711074968357734e0)
+_D = (1.05075007164441684324e-9, 5.47593808499534494600e-4, 1.51986665636164571966e-2, 1.48103976427480074590e-1,
+      6.89767334985100004550e-1, 1.67638483018380384940e0, 2.05319162663775882187e0, 1.0)
+_E = (2.01033439929228813265e-7, 2.71155556874348757815e-5, 1.24266094738807843860e-3, 2.65321895265761230930e-2,
+      2.96560571828504891230e-1, 1.78482653991729133580e0, 5.46378491116411436990e0, 6.65790464350110377720e0)
+_F = (2.04426310338993978564e-15, 1.42151175831644588870e-7, 1.84631831751005468180e-5, 7.86869131145613259100e-4,
+      1.48753612908506148525e-2, 1.36929880922735805310e-1, 5.99832206555887937690e-1, 1.0)
+
+# Acklam coefficients, highest order first
+_ACK_A = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02, 1.383577518672690e+02,
+          -3.066479806614716e+01, 2.506628277459239e+00)
+_ACK_B = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02, 6.680131188771972e+01,
+          -1.328068155288572e+01, 1.0)
+_ACK_C = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00, -2.549732539343734e+00,
+          4.374664141464968e+00, 2.938163982698783e+00)
+_ACK_D = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00, 1.0)
+_ACK_P_LOW = 0.02425
+
+def _poly(coef, x):
+    res = np.full(x.shape, coef[0])
+    for c in coef[1:]:
+        res = res*x + c
+    return res
+
+def _special_values(p, x):
+    # p = 0, 1 and p outside [0, 1]
+    x[p == 0] = -np.inf
+    x[p == 1] = np.inf
+    x[~((p >= 0) & (p <= 1))] = np.nan
+    return x
+
+def _poly_scalar(coef, x):
+    res = coef[0]
+    for c in coef[1:]:
+        res = res*x + c
+    return res
+
+def _norm_ppf_scalar(p):
+    # AS241 for one probability without numpy overhead
+    q = p - 0.5
+    if abs(q) <= 0.425:
+        r = 0.180625 - q*q
+        return q*_poly_scalar(_A, r)/_poly_scalar(_B, r)
+    if not (0 < p < 1):
+        return -math.inf if p == 0 else (math.inf if p == 1 else math.nan)
+    r = math.sqrt(-math.log(min(p, 1 - p)))
+    if r <= 5:
+        x = _poly_scalar(_C, r - 1.6)/_poly_scalar(_D, r - 1.6)
+    else:
+        x = _poly_scalar(_E, r - 5)/_poly_scalar(_F, r - 5)
+    return -x if q < 0 else x
+
+def norm_ppf(p):
+    """Inverse standard normal cdf, Wichura AS241
+
+    Args:
+        p (float or array): probabilities
+
+    Returns:
+        np.ndarray: x with Phi(x) = p (np.float64 for scalar p)
+    """
+    if np.ndim(p) == 0:
+        return np.float64(_norm_ppf_scalar(float(p)))
+    p = np.asarray(p, dtype=float)
+    q = p - 0.5
+    x = np.empty(p.shape)
+    central = np.abs(q) <= 0.425
+    if np.any(central):
+        qc = q[central]
+        r = 0.180625 - qc*qc
+        x[central] = qc*_poly(_A, r)/_poly(_B, r)
+    tail = ~central & (p > 0) & (p < 1)
+    if np.any(tail):
+        pt = p[tail]
+        r = np.sqrt(-np.log(np.minimum(pt, 1 - pt)))
+        near = r <= 5
+        xt = np.empty(r.shape)
+        rn = r[near] - 1.6
+        xt[near] = _poly(_C, rn)/_poly(_D, rn)
+        rf = r[~near] - 5
+        xt[~near] = _poly(_E, rf)/_poly(_F, rf)
+        x[tail] = np.copysign(xt, q[tail])
+    return _special_values(p, x)
+
+def norm_ppf_acklam(p, polish=False):
+    """Inverse standard normal cdf, Acklam's approximation
+
+    Args:
+        p (float or array): probabilities
+        polish (bool): one Halley step with the exact cdf
+
+    Returns:
+        np.ndarray: x with Phi(x) = p
+    """
+    p = np.asarray(p, dtype=float)
+    x = np.empty(p.shape)
+    pl = np.minimum(p, 1 - p)
+    central = pl >= _ACK_P_LOW
+    if np.any(central):
+        q = p[central] - 0.5
+        r = q*q
+        x[central] = _poly(_ACK_A, r)*q/_poly(_ACK_B, r)
+    tail = ~central & (pl > 0)
+    if np.any(tail):
+        q = np.sqrt(-2*np.log(pl[tail]))
+        xt = _poly(_ACK_C, q)/_poly(_ACK_D, q)
+        x[tail] = np.where(p[tail] < 0.5, xt, -xt)
+    if polish:
+        from scipy.special import ndtr
+        # Halley step; in the upper half on the mirrored value, as 1-p loses digits
+        xm = np.where(p > 0.5, -x, x)
+        with np.errstate(invalid='ignore', over='ignore'):
+            e = ndtr(xm) - pl
+            u = e*np.sqrt(2*np.pi)*np.exp(0.5*xm*xm)
+            xm = xm - u/(1 + 0.5*xm*u)
+        x = np.where(np.isfinite(xm), np.where(p > 0.5, -xm, xm), x)
+    return _special_values(p, x)
+
+def test_norm_ppf():
+    from scipy.stats import norm
+    p = np.concatenate((np.logspace(-300, -1, 5000), np.linspace(0.01, 0.99, 5000), 1-np.logspace(-16, -1, 1000)))
+    exact = norm.ppf(p)
+    assert(np.max(np.abs(norm_ppf(p) - exact)/np.abs(exact)) < 1e-14)
+    p = np.concatenate((np.logspace(-9, np.log10(0.499), 5000), [0.5]))
+    exact = norm.ppf(p)
+    assert(np.max(np.abs(norm_ppf_acklam(p) - exact)) < 1.15e-9*np.max(np.abs(exact)))
+    assert(np.max(np.abs(norm_ppf_acklam(p, True) - exact)) < 1e-13)
+    x = norm_ppf(np.array([0, 1, -0.1, 1.1, np.nan, 0.5]))
+    assert(x[0] == -np.inf and x[1] == np.inf and np.all(np.isnan(x[2:5])) and x[5] == 0)
+    x = [norm_ppf(v) for v in (0, 1, -0.1, 1.1, np.nan, 0.5)]
+    assert(x[0] == -np.inf and x[1] == np.inf and np.all(np.isnan(x[2:5])) and x[5] == 0)
+    # scalar path, 1-v is exact for v >= 1e-16
+    for v in np.concatenate((np.logspace(-300, -1, 300), 1-np.logspace(-16, -1, 100))):
+        assert(np.abs(norm_ppf(v) - norm.ppf(v)) <= 1e-14*np.abs(norm.ppf(v)))
+
+if __name__ == "__main__":
+    from scipy.stats import norm
+    test_norm_ppf()
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    # tail region of default probabilities
+    p = np.exp(np.random.default_rng(0).uniform(np.log(1e-9), np.log(0.5), n))
+    exact = norm.ppf(p)
+    # relative error, absolute error where x is close to 0
+    scale = np.maximum(np.abs(exact), 1e-3)
+    for name, f in (("norm.ppf", norm.ppf), ("norm_ppf (AS241)", norm_ppf), ("norm_ppf_acklam", norm_ppf_acklam),
+                    ("norm_ppf_acklam polish", lambda x: norm_ppf_acklam(x, True))):
+        f(p[:1000])
+        t0 = time.perf_counter()
+        for _ in range(5):
+            x = f(p)
+        dt = (time.perf_counter()-t0)/5
+        t0 = time.perf_counter()
+        for j in range(1000):
+            f(p[j])
+        dt_scalar = (time.perf_counter()-t0)/1000
+        print("{:24s}: max rel error {:.2e}, {:.1f} ns/element ({} elements), {:.1f} us/scalar call".format(
+            name, np.max(np.abs(x-exact)/scale), 1e9*dt/n, n, 1e6*dt_scalar))
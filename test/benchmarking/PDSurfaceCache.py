@@ -0,0 +1,424 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Precomputed default probability and price surfaces for quoting.
+#
+# For a given AMM state (K2, L1, M1, M2, M3 and the perpetual parameters)
+# the distance to default dd of calculate_perp_price is tabulated on a grid
+# over the trade size and the index price ratio s2/s2_0. dd is much smoother
+# than the default probability q = norm.cdf(dd) and is clipped to
+# [-DD_CLIP, DD_CLIP] (q is 0 or 1 within double precision there). The
+# price is s2*(1 + sign(k-kStar)*q + sign(k)*minSpread), so the price
+# surface follows from the dd surface: the jumps at k=kStar and k=0 are
+# added analytically and never interpolated. To that end the trade size
+# axis is u = k - kStar(s2) with separate grids for u<0 and u>0.
+#
+# Grids: uniform in s2/s2_0 (one extra point on each side), and uniform in
+# sqrt(|u|), denser close to kStar where the surface is most curved. Both
+# cell indices follow from the query by arithmetic, without a search or
+# grid lookups. dd is interpolated cubically (Catmull-Rom) in s2 and
+# linearly in |u|. Queries outside the grid are evaluated exactly.
+# Scalar queries (single quotes) use a separate path with the math module,
+# about 4x faster than calculate_perp_price; array queries are evaluated in
+# cache-sized chunks and are about 1.5-2x faster than
+# calculate_perp_price_vec.
+#
+# The surface is rebuilt whenever a state variable other than s2 changes
+# (PDSurfaceCache.get). For quanto perpetuals that includes s3, so a moving
+# quanto index costs a rebuild per change.
+#
+# The error bound is empirical: the maximal error of q at all cell midpoints,
+# measured when the surface is built (for a smooth surface the
+# interpolation error is largest there). The price error bound is s2 times
+# that value. test_surface_cache checks it on random queries.
+#
+# The surfaces live in a multiprocessing.shared_memory block. Worker
+# processes attach to the block by name (attach_surface) and read it
+# without copying. The writer protects rebuilds with a sequence counter
+# (seqlock): readers retry if the counter is odd or changed while reading.
+
+import time
+import math
+import numpy as np
+from multiprocessing import shared_memory, Process
+from scipy.special import ndtr
+from PricingBenchmark import prob_def_no_quanto_vec, prob_def_quanto_vec, calculate_perp_price_vec, \
+    calculate_perp_price
+
+# header layout of the shared memory block (float64 entries)
+_HEADER = ["seq", "nx", "nu", "max_u", "max_x", "K2", "L1", "s2", "s3", "sig2", "sig3",
+           "rho", "r", "M1", "M2", "M3", "minSpread", "err_q"]
+_H = {name: j for j, name in enumerate(_HEADER)}
+STATE_KEYS = _HEADER[_H["K2"]:_H["minSpread"]+1]
+# state variables that trigger a rebuild: all but the index price, whose
+# moves are on the grid. s3, sig3 and rho only enter quanto surfaces (M3!=0)
+REBUILD_KEYS = ["K2", "L1", "sig2", "r", "M1", "M2", "M3", "minSpread"]
+QUANTO_REBUILD_KEYS = ["s3", "sig3", "rho"]
+
+def _k_star_coef(state):
+    # kStar as in calculate_perp_price, kStar = a + b/s2
+    b = 0.0
+    if state["M3"] != 0:
+        b = state["s3"]*(np.exp(state["rho"]*state["sig2"]*state["sig3"])-1) / \
+            (np.exp(state["sig2"]**2)-1)*state["M3"]
+    return state["M2"] - state["K2"], b
+
+def _k_star(state, s2):
+    a, b = _k_star_coef(state)
+    return a + b/s2
+
+DD_CLIP = 10
+# array queries are evaluated in chunks whose temporaries stay in the cache
+QUERY_CHUNK = 16384
+SQRT_HALF = math.sqrt(0.5)
+
+def _dd(state, k, s2):
+    # clipped distance to default of the AMM after a trade of size k at index s2
+    args = (s2, state["s3"], state["sig2"], state["sig3"], state["rho"], state["r"],
+            state["M1"], state["M2"])
+    K2, L1 = state["K2"] + k, state["L1"] + k*s2
+    if state["M3"] == 0:
+        _, dd = prob_def_no_quanto_vec(K2, L1, *args, 0)
+    else:
+        _, dd = prob_def_quanto_vec(K2, L1, *args, state["M3"])
+    return np.clip(dd, -DD_CLIP, DD_CLIP)
+
+def _buffer_size(nx, nu):
+    # header, x grid, |u| grid, dd for u<0, dd for u>0
+    return len(_HEADER) + nx + nu + 2*nx*nu
+
+def _catmull_rom(p0, p1, p2, p3, t):
+    # cubic through p1 (t=0) and p2 (t=1)
+    return p1 + 0.5*t*(p2 - p0 + t*(2*p0 - 5*p1 + 4*p2 - p3 + t*(3*(p1 - p2) + p3 - p0)))
+
+
+class PDSurface:
+    """View on a surface stored in a float64 buffer (shared memory)
+
+    Args:
+        buf (np.ndarray): float64 buffer with header and grids
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self._state, self._params, self._state_seq = None, None, -1
+        self._update_views()
+
+    def _update_views(self):
+        nx, nu = int(self.buf[_H["nx"]]), int(self.buf[_H["nu"]])
+        j = len(_HEADER)
+        # s2/s2_0 and |u| grids
+        self.x_grid = self.buf[j:j+nx]
+        self.u_grid = self.buf[j+nx:j+nx+nu]
+        j += nx+nu
+        # index 0: u<0, index 1: u>0
+        self.dd = self.buf[j:j+2*nx*nu].reshape(2, nx, nu)
+        self.tab = self.buf[j:j+2*nx*nu]
+
+    def _refresh(self):
+        # state and index arithmetic constants, cached until the next rebuild
+        seq = self.buf[_H["seq"]]
+        if seq != self._state_seq:
+            self._state = {name: float(self.buf[_H[name]]) for name in STATE_KEYS}
+            nx, nu = self.x_grid.shape[0], self.u_grid.shape[0]
+            s2_0, max_u = self._state["s2"], float(self.buf[_H["max_u"]])
+            x0, dx = float(self.x_grid[0]), float(self.x_grid[1] - self.x_grid[0])
+            a, b = (float(v) for v in _k_star_coef(self._state))
+            # s2 -> fractional x index fx = s2*fx_scale - fx_shift,
+            # |u| -> fractional index sqrt(|u|*inv_cu) on the sqrt grid
+            self._params = (nx, nu, 1/(s2_0*dx), x0/dx, (nu-1)**2/max_u, a, b, self._state["minSpread"],
+                            float(self.buf[_H["err_q"]]))
+            self._state_seq = seq
+        return self._state, self._params
+
+    @property
+    def state(self):
+        return self._refresh()[0]
+
+    def build(self, state, max_u, max_x):
+        """Evaluate the surface for state on the grid of the buffer
+
+        Args:
+            state (dict): K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread
+            max_u (float): grid covers |k-kStar| <= max_u
+            max_x (float): grid covers |log(s2/state['s2'])| <= max_x
+        """
+        buf = self.buf
+        buf[_H["seq"]] += 1
+        nx, nu = self.x_grid.shape[0], self.u_grid.shape[0]
+        for name in STATE_KEYS:
+            buf[_H[name]] = state[name]
+        buf[_H["max_u"]], buf[_H["max_x"]] = max_u, max_x
+        # cells 1..nx-3 cover the range, the outer points serve the cubic
+        lo, hi = np.exp(-max_x), np.exp(max_x)
+        dx = (hi - lo)/(nx - 3)
+        self.x_grid[:] = lo + dx*np.arange(-1, nx-1)
+        self.u_grid[:] = max_u*np.linspace(0, 1, nu)**2
+        s2 = state["s2"]*self.x_grid[:, None]
+        kStar = _k_star(state, s2)
+        self.dd[0] = _dd(state, kStar - self.u_grid[None, :], s2)
+        self.dd[1] = _dd(state, kStar + self.u_grid[None, :], s2)
+        # error bound: compare interpolation and exact value at cell midpoints
+        buf[_H["err_q"]] = 0
+        s2m = state["s2"]*(0.5*(self.x_grid[1:-2] + self.x_grid[2:-1]))[:, None]
+        um = 0.5*(self.u_grid[1:] + self.u_grid[:-1])[None, :]
+        err = 0
+        for sgn in (-1, 1):
+            k = np.broadcast_to(_k_star(state, s2m) + sgn*um, (s2m.shape[0], um.shape[1])).reshape(-1)
+            s2k = np.broadcast_to(s2m, (s2m.shape[0], um.shape[1])).reshape(-1)
+            dd_interp = self._query(k, s2k)[1]
+            err = max(err, np.max(np.abs(ndtr(dd_interp) - ndtr(_dd(state, k, s2k)))))
+        buf[_H["err_q"]] = err
+        buf[_H["seq"]] += 1
+
+    def _query(self, k, s2):
+        k, s2 = np.broadcast_arrays(np.asarray(k, dtype=float), np.asarray(s2, dtype=float))
+        shape = k.shape
+        k, s2 = k.reshape(-1), s2.reshape(-1)
+        if k.shape[0] <= QUERY_CHUNK:
+            return tuple(v.reshape(shape) for v in self._query_chunk(k, s2))
+        res = tuple(np.empty(k.shape[0]) for _ in range(4))
+        for start in range(0, k.shape[0], QUERY_CHUNK):
+            chunk = self._query_chunk(k[start:start+QUERY_CHUNK], s2[start:start+QUERY_CHUNK])
+            for v, c in zip(res, chunk):
+                v[start:start+QUERY_CHUNK] = c
+        return tuple(v.reshape(shape) for v in res)
+
+    def _query_chunk(self, k, s2):
+        state, (nx, nu, fx_scale, fx_shift, inv_cu, a, b, minSpread, err_q) = self._refresh()
+        u = k - a if b == 0 else k - (a + b/s2)
+        au = np.abs(u)
+        fx = s2*fx_scale - fx_shift
+        i = fx.astype(np.int64)
+        fu = np.sqrt(au*inv_cu)
+        j = fu.astype(np.int64)
+        in_grid = (fx >= 1) & (i <= nx-3) & (j <= nu-2)
+        all_in = np.all(in_grid)
+        if not all_in:
+            i[~in_grid], j[~in_grid] = 1, 0
+        t = fx - i
+        jf = j.astype(float)
+        # linear in |u| on the grid |u|_j = j^2/inv_cu
+        wu = (au*inv_cu - jf*jf)/(2*jf + 1)
+        flat = (u >= 0)*(nx*nu) + (i-1)*nu + j
+        tab = self.tab
+        p = []
+        for _ in range(4):
+            d0 = tab.take(flat)
+            p.append(d0 + wu*(tab.take(flat+1) - d0))
+            flat += nu
+        dd = _catmull_rom(p[0], p[1], p[2], p[3], t)
+        if not all_in:
+            out = ~in_grid
+            dd[out] = _dd(state, k[out], s2[out])
+        q = ndtr(dd)
+        price = s2*(1 + np.sign(u)*q + np.sign(k)*minSpread)
+        return q, dd, price, err_q*s2*in_grid
+
+    def _query_scalar(self, k, s2):
+        # _query for one trade, without numpy overhead
+        state, (nx, nu, fx_scale, fx_shift, inv_cu, a, b, minSpread, err_q) = self._refresh()
+        u = k - a - b/s2
+        au = abs(u)
+        fx = s2*fx_scale - fx_shift
+        i = int(fx)
+        fu = math.sqrt(au*inv_cu)
+        j = int(fu)
+        if fx >= 1 and i <= nx-3 and j <= nu-2:
+            t = fx - i
+            wu = (au*inv_cu - j*j)/(2*j + 1)
+            flat = (u >= 0)*(nx*nu) + (i-1)*nu + j
+            tab = self.tab
+            p = []
+            for _ in range(4):
+                d0 = float(tab[flat])
+                p.append(d0 + wu*(float(tab[flat+1]) - d0))
+                flat += nu
+            dd = _catmull_rom(p[0], p[1], p[2], p[3], t)
+            price_err = err_q*s2
+        else:
+            dd = float(_dd(state, np.array([k]), np.array([s2]))[0])
+            price_err = 0.0
+        q = 0.5*math.erfc(-dd*SQRT_HALF)
+        price = s2*(1 + ((u > 0) - (u < 0))*q + ((k > 0) - (k < 0))*minSpread)
+        return q, dd, price, price_err
+
+    def query(self, k, s2):
+        """Default probability, distance to default and price after a trade
+
+        Args:
+            k (float or array): trade sizes
+            s2 (float or array): index prices
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray, np.ndarray): pd, dd, price
+                and bound on the absolute price error (0 for exact values),
+                floats for scalar k and s2
+        """
+        is_scalar = np.ndim(k) == 0 and np.ndim(s2) == 0
+        while True:
+            seq = self.buf[_H["seq"]]
+            if seq % 2 == 1:
+                # rebuild in progress
+                time.sleep(0)
+                continue
+            if is_scalar:
+                res = self._query_scalar(float(k), float(s2))
+            else:
+                res = self._query(k, s2)
+            if self.buf[_H["seq"]] == seq:
+                break
+        return res
+
+
+class PDSurfaceCache:
+    """Writer side: one shared memory surface per perpetual, rebuilt lazily
+
+    Args:
+        nx (int): number of grid points in the index price ratio
+        nu (int): number of grid points in |k-kStar| (per side)
+        max_x (float): largest tabulated log index price move
+        max_u_factor (float): grid covers |k-kStar| <= max_u_factor*max(|K2|, |M2|, 1e-6)
+        prefix (str): prefix of the shared memory block names
+    """
+    def __init__(self, nx=65, nu=1025, max_x=0.1, max_u_factor=2, prefix="perp_pd_surface"):
+        self.nx, self.nu = nx, nu
+        self.max_x, self.max_u_factor = max_x, max_u_factor
+        self.prefix = prefix
+        self.shm = dict()
+        self.surfaces = dict()
+        self.num_builds = 0
+
+    def block_name(self, perp_id):
+        return self.prefix + "_" + str(perp_id)
+
+    def get(self, perp_id, state):
+        """Surface for perp_id, rebuilt if any state variable other than s2
+        changed (s3, sig3 and rho only for quanto perpetuals)
+
+        Args:
+            perp_id (int or str): perpetual id
+            state (dict): K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread
+
+        Returns:
+            PDSurface: surface (in shared memory)
+        """
+        if perp_id not in self.surfaces:
+            size = 8*_buffer_size(self.nx, self.nu)
+            shm = shared_memory.SharedMemory(name=self.block_name(perp_id), create=True, size=size)
+            buf = np.ndarray((_buffer_size(self.nx, self.nu),), dtype=np.float64, buffer=shm.buf)
+            buf[:] = 0
+            buf[_H["nx"]], buf[_H["nu"]] = self.nx, self.nu
+            self.shm[perp_id] = shm
+            self.surfaces[perp_id] = PDSurface(buf)
+            needs_build = True
+        else:
+            old = self.surfaces[perp_id].state
+            keys = REBUILD_KEYS + (QUANTO_REBUILD_KEYS if state["M3"] != 0 else [])
+            needs_build = any(old[key] != state[key] for key in keys)
+        if needs_build:
+            max_u = self.max_u_factor*max(np.abs(state["K2"]), np.abs(state["M2"]), 1e-6)
+            self.surfaces[perp_id].build(state, max_u, self.max_x)
+            self.num_builds += 1
+        return self.surfaces[perp_id]
+
+    def close(self):
+        for shm in self.shm.values():
+            shm.close()
+            shm.unlink()
+        self.shm, self.surfaces = dict(), dict()
+
+
+def attach_surface(name):
+    """Attach to a surface created by PDSurfaceCache in another process
+
+    Args:
+        name (str): shared memory block name (PDSurfaceCache.block_name)
+
+    Returns:
+        (PDSurface, SharedMemory): surface and the block, keep the block
+            referenced while using the surface and close() it afterwards
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    header = np.ndarray((len(_HEADER),), dtype=np.float64, buffer=shm.buf)
+    n = _buffer_size(int(header[_H["nx"]]), int(header[_H["nu"]]))
+    buf = np.ndarray((n,), dtype=np.float64, buffer=shm.buf)
+    return PDSurface(buf), shm
+
+def _worker_query(name, k, s2, expected_price):
+    surface, shm = attach_surface(name)
+    _, _, price, err = surface.query(k, s2)
+    assert(np.all(np.abs(price - expected_price) <= 1e-9*np.abs(expected_price)))
+    del surface
+    shm.close()
+
+def _best_time(f, repeat=5):
+    res = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        res = min(res, time.perf_counter()-t0)
+    return res
+
+def test_surface_cache():
+    state = dict(K2=0.4, L1=0.4*36000, s2=38000, s3=2000, sig2=0.05, sig3=0.07,
+                 rho=0.5, r=0, M1=10, M2=0.06, M3=0, minSpread=0.0002)
+    rng = np.random.default_rng(3)
+    n = 200000
+    cache = PDSurfaceCache()
+    try:
+        for M3 in (0, 0.04):
+            state["M3"] = M3
+            t0 = time.time()
+            surface = cache.get(1, state)
+            print("M3 =", M3, ": build", np.round((time.time()-t0)*1000, 2), "ms, price error bound at s2",
+                  np.round(surface.buf[_H["err_q"]]*state["s2"], 6))
+            k = rng.uniform(-0.5, 0.5, n)
+            s2 = state["s2"]*np.exp(rng.uniform(-0.09, 0.09, n))
+            args = (state["s3"], state["sig2"], state["sig3"], state["rho"], state["r"], state["M1"], state["M2"],
+                    state["M3"], state["minSpread"])
+            q, dd, price, price_err = surface.query(k, s2)
+            price_exact = calculate_perp_price_vec(state["K2"], k, state["L1"], s2, *args)
+            err = np.abs(price - price_exact)
+            # the empirical bound holds for random queries
+            assert(np.all(err <= price_err + 1e-9*price_exact))
+            # single quotes, as requested by the quote service, agree with array queries
+            for j in range(1000):
+                q_j, dd_j, price_j, err_j = surface.query(k[j], s2[j])
+                assert(abs(price_j - price[j]) <= 1e-9*price[j] and err_j == price_err[j])
+            t_interp = _best_time(lambda: surface.query(k, s2))
+            t_exact = _best_time(lambda: calculate_perp_price_vec(state["K2"], k, state["L1"], s2, *args))
+            print("  max price error", np.round(np.max(err), 6), ", interpolation", np.round(t_interp*1000, 2),
+                  "ms, exact", np.round(t_exact*1000, 2), "ms")
+            t_interp = _best_time(lambda: [surface.query(k[j], s2[j]) for j in range(1000)])
+            t_exact = _best_time(lambda: [calculate_perp_price(state["K2"], k[j], state["L1"], s2[j], *args)
+                                          for j in range(1000)])
+            print("  1000 single queries: interpolation", np.round(t_interp*1000, 2), "ms, exact (scalar)",
+                  np.round(t_exact*1000, 2), "ms")
+            # state unchanged apart from index price: no rebuild
+            num_builds = cache.num_builds
+            cache.get(1, dict(state, s2=state["s2"]*1.01))
+            assert(cache.num_builds == num_builds)
+        # any other state change is reflected in the quotes, with and without quanto
+        for M3 in (0, 0.04):
+            for key, value in (("s3", 2600), ("sig2", 0.1), ("sig3", 0.12), ("rho", -0.3), ("r", 0.01),
+                               ("minSpread", 0.002), ("M1", 20)):
+                new_state = dict(state, M3=M3)
+                new_state[key] = value
+                surface = cache.get(1, new_state)
+                args = tuple(new_state[name] for name in ("s3", "sig2", "sig3", "rho", "r", "M1", "M2", "M3",
+                                                          "minSpread"))
+                _, _, price, price_err = surface.query(k[:1000], s2[:1000])
+                price_exact = calculate_perp_price_vec(new_state["K2"], k[:1000], new_state["L1"], s2[:1000], *args)
+                assert(np.all(np.abs(price - price_exact) <= price_err + 1e-9*price_exact))
+                price_j = surface.query(k[0], s2[0])[2]
+                assert(abs(price_j - price_exact[0]) <= price_err[0] + 1e-9*price_exact[0])
+        # read the surface from another process
+        p = Process(target=_worker_query, args=(cache.block_name(1), k[:100], s2[:100], price[:100]))
+        p.start()
+        p.join()
+        assert(p.exitcode == 0)
+    finally:
+        cache.close()
+
+if __name__ == "__main__":
+    test_surface_cache()
@@ -0,0 +1,185 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Batch model of the pool settlement in PerpetualSettlement.sol
+#
+# The contract clears one trader per call (settleNextTraderInPool ->
+# _clearTrader -> _countMargin) and sets the redemption rate once all
+# traders of the emergency perpetuals are cleared. Here all accounts of the
+# pool are cleared in one vectorized pass:
+#   - margin balance of each trader at the settlement prices
+#   - margin <= 0: added to the AMM cash of the perpetual (loss not paid back)
+#   - margin > 0 and position != 0: counted in the total trader margin
+#   - redemption rate = min(1, total capital / total trader margin), with
+#     total capital = participation fund + default fund + AMM fund cash and
+#     AMM margin cash of the emergency perpetuals (_setRedemptionRate)
+#   - default fund and participation fund corrections (_prepareRedemption)
+#   - settleable margin per trader (_getSettleableMargin): 0 if the margin
+#     is negative, margin*rate with open position, full margin otherwise.
+#     settle only transfers positive amounts, so the payout is floored at 0
+#     (relevant if the total capital and hence the rate are negative)
+#
+# Account store (dict of arrays, one entry per trader account):
+#   perp: index of the perpetual, pos: position BC, L: locked-in value QC,
+#   cash: cash CC
+# Perpetuals (dict of arrays, one entry per perpetual of the pool):
+#   is_emergency, S2, S3, mark_premium (settlement prices),
+#   collateral_currency_index, amm_pos, amm_L, amm_cash, amm_fund_cash
+# Pool (dict): pnl_participants_cash, default_fund_cash
+#
+# usage: python PoolSettlement.py [num_accounts] [num_perpetuals]
+
+import sys
+import time
+import numpy as np
+from test_liquidations import get_margin_balance_cc_vec
+
+def _margin_balance(accounts, perps, sl=slice(None)):
+    p = accounts["perp"][sl]
+    return get_margin_balance_cc_vec(accounts["pos"][sl], accounts["L"][sl], perps["S2"][p], perps["S3"][p],
+        perps["mark_premium"][p], accounts["cash"][sl], perps["collateral_currency_index"][p])
+
+def settle_pool(accounts, perps, pool, chunk_size=1000000):
+    """Clear all emergency perpetuals of the pool and compute the payouts
+
+    Args:
+        accounts (dict): account store, arrays perp, pos, L, cash
+        perps (dict): perpetual data, see module description
+        pool (dict): pnl_participants_cash, default_fund_cash
+        chunk_size (int): number of accounts processed per vectorized step
+
+    Returns:
+        dict: redemption_rate, payout (per account, 0 for accounts of
+            perpetuals that are not settled), trader_margin and amm_cash
+            (per perpetual, after clearing), default_fund_cash and
+            pnl_participants_cash after the redemption
+    """
+    num_perps = perps["S2"].shape[0]
+    num_accounts = accounts["perp"].shape[0]
+    is_emrg = np.asarray(perps["is_emergency"], dtype=bool)
+    total_margin = np.zeros(num_perps)
+    amm_cash = np.array(perps["amm_cash"], dtype=float)
+    margin = np.empty(num_accounts)
+    for start in range(0, num_accounts, chunk_size):
+        sl = slice(start, min(start + chunk_size, num_accounts))
+        p = accounts["perp"][sl]
+        m = _margin_balance(accounts, perps, sl)
+        margin[sl] = m
+        cleared = is_emrg[p]
+        # negative margin is charged to the AMM (_countMargin)
+        amm_cash += np.bincount(p, weights=np.where(cleared & (m <= 0), m, 0), minlength=num_perps)
+        total_margin += np.bincount(p, weights=np.where(cleared & (m > 0) & (accounts["pos"][sl] != 0), m, 0),
+                                    minlength=num_perps)
+    amm_margin = get_margin_balance_cc_vec(perps["amm_pos"], perps["amm_L"], perps["S2"], perps["S3"],
+        perps["mark_premium"], amm_cash, perps["collateral_currency_index"])
+    total_trader_margin = np.sum(total_margin[is_emrg])
+    total_amm_fund_cash = np.sum((perps["amm_fund_cash"] + amm_cash)[is_emrg])
+    total_capital = pool["pnl_participants_cash"] + pool["default_fund_cash"] + total_amm_fund_cash
+    # _setRedemptionRate
+    rate = total_capital/total_trader_margin if total_capital < total_trader_margin else 1.0
+    # _prepareRedemption
+    withdraw_df = -np.sum(amm_margin[is_emrg])*rate - total_amm_fund_cash
+    withdraw_participation = 0
+    if withdraw_df > 0:
+        withdraw_participation, withdraw_df = withdraw_df, 0
+        if withdraw_participation > pool["pnl_participants_cash"]:
+            withdraw_df = withdraw_participation - pool["pnl_participants_cash"]
+            withdraw_participation = pool["pnl_participants_cash"]
+    # _getSettleableMargin
+    payout = np.empty(num_accounts)
+    for start in range(0, num_accounts, chunk_size):
+        sl = slice(start, min(start + chunk_size, num_accounts))
+        m = margin[sl]
+        pay = np.where(accounts["pos"][sl] != 0, m*rate, m)
+        payout[sl] = np.where(is_emrg[accounts["perp"][sl]] & (m > 0), np.maximum(pay, 0), 0)
+    return {"redemption_rate": rate, "payout": payout, "trader_margin": total_margin, "amm_cash": amm_cash,
+            "default_fund_cash": pool["default_fund_cash"] - withdraw_df,
+            "pnl_participants_cash": pool["pnl_participants_cash"] - withdraw_participation}
+
+def settle_pool_sequential(accounts, perps, pool):
+    # reference: clears one trader at a time like settleNextTraderInPool
+    num_perps = perps["S2"].shape[0]
+    total_margin = np.zeros(num_perps)
+    amm_cash = np.array(perps["amm_cash"], dtype=float)
+    margins = _margin_balance(accounts, perps)
+    for j in range(accounts["perp"].shape[0]):
+        p = accounts["perp"][j]
+        if not perps["is_emergency"][p]:
+            continue
+        margin = margins[j]
+        if margin <= 0:
+            amm_cash[p] += margin
+        elif accounts["pos"][j] != 0:
+            total_margin[p] += margin
+    fTotalTraderMarginBalance = 0
+    fTotalEmrgAMMMarginBalance = 0
+    fTotalEmrgAMMFundCashCC = 0
+    for p in range(num_perps):
+        if perps["is_emergency"][p]:
+            fTotalTraderMarginBalance += total_margin[p]
+            fTotalEmrgAMMMarginBalance += get_margin_balance_cc_vec(perps["amm_pos"][p], perps["amm_L"][p],
+                perps["S2"][p], perps["S3"][p], perps["mark_premium"][p], amm_cash[p],
+                perps["collateral_currency_index"][p])
+            fTotalEmrgAMMFundCashCC += perps["amm_fund_cash"][p] + amm_cash[p]
+    fTotalCapitalCC = pool["pnl_participants_cash"] + pool["default_fund_cash"] + fTotalEmrgAMMFundCashCC
+    if fTotalCapitalCC < fTotalTraderMarginBalance:
+        rate = fTotalCapitalCC/fTotalTraderMarginBalance
+    else:
+        rate = 1.0
+    payout = np.zeros(accounts["perp"].shape[0])
+    for j in range(accounts["perp"].shape[0]):
+        if perps["is_emergency"][accounts["perp"][j]] and margins[j] > 0:
+            payout[j] = max(margins[j]*rate, 0) if accounts["pos"][j] != 0 else margins[j]
+    return rate, payout
+
+def random_pool(num_accounts, num_perps, rng):
+    """Random emergency pool for settlement rehearsals"""
+    S2_0 = np.exp(rng.uniform(np.log(10), np.log(50000), num_perps))
+    # all perpetuals of a pool share the collateral currency: quote currency
+    # or a common quanto currency
+    perps = {"is_emergency": rng.random(num_perps) < 0.7,
+             "S2": S2_0*np.exp(rng.normal(0, 0.05, num_perps)),
+             "S3": np.full(num_perps, np.exp(rng.uniform(np.log(10), np.log(50000)))),
+             "collateral_currency_index": np.full(num_perps, rng.choice((0, 2)))}
+    perps["is_emergency"][0] = True
+    perps["mark_premium"] = perps["S2"]*rng.normal(0, 0.002, num_perps)
+    fx = np.where(perps["collateral_currency_index"] == 0, 1,
+                  np.where(perps["collateral_currency_index"] == 1, perps["S2"], perps["S3"]))
+    perp = rng.integers(0, num_perps, num_accounts)
+    pos = rng.normal(0, 1, num_accounts)
+    pos[rng.random(num_accounts) < 0.1] = 0
+    entry = S2_0[perp]*np.exp(rng.normal(0, 0.02, num_accounts))
+    accounts = {"perp": perp, "pos": pos, "L": pos*entry,
+                "cash": np.abs(pos)*S2_0[perp]/fx[perp]*rng.uniform(0.05, 0.3, num_accounts)}
+    # AMM is the counterparty of all traders, funds are scaled with the open interest
+    notional_cc = np.bincount(perp, weights=np.abs(pos), minlength=num_perps)*S2_0/fx
+    perps["amm_pos"] = -np.bincount(perp, weights=pos, minlength=num_perps)
+    perps["amm_L"] = -np.bincount(perp, weights=accounts["L"], minlength=num_perps)
+    perps["amm_cash"] = 0.05*notional_cc
+    perps["amm_fund_cash"] = 0.02*notional_cc
+    pool = {"pnl_participants_cash": 0.01*float(np.sum(notional_cc)),
+            "default_fund_cash": 0.02*float(np.sum(notional_cc))}
+    return accounts, perps, pool
+
+def test_settlement_vs_sequential():
+    rng = np.random.default_rng(7)
+    for _ in range(5):
+        accounts, perps, pool = random_pool(5000, 4, rng)
+        res = settle_pool(accounts, perps, pool, chunk_size=777)
+        rate, payout = settle_pool_sequential(accounts, perps, pool)
+        assert(np.abs(res["redemption_rate"] - rate) < 1e-12)
+        assert(np.allclose(res["payout"], payout, rtol=1e-12, atol=1e-12))
+
+if __name__ == "__main__":
+    num_accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    num_perps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    test_settlement_vs_sequential()
+    accounts, perps, pool = random_pool(num_accounts, num_perps, np.random.default_rng(0))
+    t0 = time.time()
+    res = settle_pool(accounts, perps, pool)
+    print("settled", num_accounts, "accounts in", num_perps, "perpetuals in", np.round(time.time()-t0, 3), "s")
+    print("emergency perpetuals:", np.nonzero(perps["is_emergency"])[0])
+    print("redemption rate =", res["redemption_rate"])
+    print("total payout =", np.sum(res["payout"]))
+    print("default fund cash:", pool["default_fund_cash"], "->", res["default_fund_cash"])
+    print("participation fund cash:", pool["pnl_participants_cash"], "->", res["pnl_participants_cash"])
@@ -6,6 +6,9 @@ import numpy as np
 from scipy.stats import norm
 from scipy.optimize import minimize
 import matplotlib.pyplot as plot
+from ResultCache import cached
+import NormalInverse
+from NormalInverse import norm_ppf
 
 def get_variance_Z_withC(r, sig2, sig3, rho, C3):
     return np.exp(2*r)*(
@@ -77,6 +80,45 @@ def calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minS
     sgnm = np.sign(k-kStar)
     return s2*(1 + sgnm*q + np.sign(k)*minSpread)
 
+# vectorized versions of the functions above: all arguments can be
+# numpy arrays (broadcast against each other), results match the
+# scalar functions element by element
+
+def prob_def_quanto_vec(K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        C3 = M3*s3/(M2*s2-K2*s2)
+        sigz = np.sqrt(get_variance_Z_withC(r, sig2, sig3, rho, C3))
+        muz = np.exp(r)*(1+C3)
+        dd = ((-L1-M1)/(s2*(M2-K2))-muz)/sigz
+    dd = np.where(M2-K2<0, -dd, dd)
+    return norm.cdf(dd), dd
+
+def prob_def_no_quanto_vec(K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3):
+    kstar = M2-K2
+    no_default = np.logical_and(kstar>=0, -L1-M1<=0)
+    sure_default = np.logical_and(kstar<=0, -L1-M1>0)
+    muY = r-0.5*sig2**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Qplus_score = np.log((-L1-M1)/(s2*kstar)) - muY
+        dd = Qplus_score/sig2
+    dd = np.where(kstar<0, -dd, dd)
+    dd = np.where(no_default, -100, np.where(sure_default, 100, dd))
+    Qplus = norm.cdf(dd)
+    Qplus = np.where(no_default, 0, np.where(sure_default, 1, Qplus))
+    return Qplus, dd
+
+def calculate_perp_price_vec(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread=0.0001):
+    dL = k*s2
+    q0, _ = prob_def_no_quanto_vec(K2+k, L1+dL, s2, s3, sig2, sig3, rho, r, M1, M2, 0)
+    q3, _ = prob_def_quanto_vec(K2+k, L1+dL, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
+    is_quanto = M3!=0
+    q = np.where(is_quanto, q3, q0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = s3/s2*(np.exp(rho*sig2*sig3)-1)/(np.exp(sig2*sig2)-1)*M3
+    kStar = M2 - K2 + np.where(is_quanto, h, 0)
+    sgnm = np.sign(k-kStar)
+    return s2*(1 + sgnm*q + np.sign(k)*minSpread)
+
 
 def bad_cdf_approximation(dd):
     # this function provides an approximation for
@@ -144,7 +186,7 @@ def get_target_collateral_M3_fromPD(q, K2, s2, s3, L1, sig2, sig3, rho, r):
     a = np.exp(sig3**2)-1
     b = 2*(np.exp(sig3*sig2*rho)-1)
     c = np.exp(sig2**2)-1
-    qinv2 = norm.ppf(q)**2
+    qinv2 = norm_ppf(q)**2
     v= -s3/s2/K2
     a0 = (a*qinv2-1)*v**2
     b0 = (b*qinv2-2+2*kappa*np.exp(-r))*v
@@ -157,6 +199,34 @@ def get_target_collateral_M3_fromPD(q, K2, s2, s3, L1, sig2, sig3, rho, r):
     # print(a0*Mstar2**2 + b0*Mstar2 +c0)
     return Mstar1, Mstar2
 
+# vectorized target collateral functions (without the pd check)
+
+def get_target_collateral_M1_vec(_fK2, _fS2, _fL1, _fSigma2, _fTargetDD):
+    fMu2 = -0.5*_fSigma2**2
+    fSgn = np.where(_fK2<0, 1, -1)
+    return _fK2 * _fS2 * np.exp(fMu2 + fSgn*_fSigma2*_fTargetDD) - _fL1
+
+def get_target_collateral_M2_vec(_fK2, _fS2, _fL1, _fSigma2, _fTargetDD):
+    fMu2 = -0.5*_fSigma2**2
+    fSgn = np.where(_fL1<0, 1, -1)
+    return _fK2  - _fL1/np.exp(fMu2 + fSgn*_fSigma2*_fTargetDD)/_fS2
+
+def get_target_collateral_M3_vec(K2, s2, s3, L1, sig2, sig3, rho, r, _fTargetDD):
+    kappa = L1/s2/K2
+    a = np.exp(sig3**2)-1
+    b = 2*(np.exp(sig3*sig2*rho)-1)
+    c = np.exp(sig2**2)-1
+    qinv2 = _fTargetDD**2
+    v= -s3/s2/K2
+    a0 = (a*qinv2-1)*v**2
+    b0 = (b*qinv2-2+2*kappa*np.exp(-r))*v
+    c0 = c*qinv2 - kappa**2*np.exp(-2*r)+2*kappa*np.exp(-r)-1
+    with np.errstate(invalid='ignore'):
+        sqrt_disc = np.sqrt(b0**2-4*a0*c0)
+    Mstar1 = (-b0 + sqrt_disc)/(2*a0)
+    Mstar2 = (-b0 - sqrt_disc)/(2*a0)
+    return np.maximum(Mstar1, Mstar2)
+
 
 def get_DF_target_size(K2pair, k2TraderPair, r2pair, r3pair, n,
                             s2, s3, currency_idx):
@@ -268,15 +338,16 @@ def test_pricing():
     p3 = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread)
     print("p3=", p3)
     
-def mc_default_prob(K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3):
-
+def mc_default_prob(K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, rng=None):
+    # rng: optional np.random.Generator, default the global np.random state
     assert(M3==0)
+    rng = np.random if rng is None else rng
     N = 2
     n = 1e6
     num_defaults = 0
     mu = r-sig2**2/2
     for j in range(N):
-        r2 = np.random.normal(mu, sig2, int(n))
+        r2 = rng.normal(mu, sig2, int(n))
         num_defaults += sum(np.exp(r2)*s2*(M2-K2)<-L1-M1)
     pd = num_defaults/(n*N)    
     return pd
@@ -288,7 +359,7 @@ def liquidation_price_quanto(LockedInValueQC, position, cash_cc, maintenance_mar
     rho23, sigma2, sigma3, S2, S3):
 
     alpha = np.abs(position) * maintenance_margin_ratio - position
-    normInv = norm.ppf(0.75); #<- prob of being liquidated
+    normInv = norm_ppf(0.75); #<- prob of being liquidated
     gamma = cash_cc*S3*np.exp(normInv*np.sqrt(1-rho23)*sigma3)
     omega = np.sqrt(rho23)*sigma3/sigma2
     def f(x):
@@ -337,6 +408,26 @@ def test_liq_price():
     plot.show()
 
 
+@cached(depends=(liquidation_price_quanto, liquidation_price_quantoV2, NormalInverse))
+def liq_price_quanto_sweep(cash_min, test_delta, L, pos, maintenance_margin_ratio,
+    rho23, sigma2, sigma3, S2, S3):
+    """liquidation_price_quanto and liquidation_price_quantoV2 for cash = cash_min + test_delta"""
+    S2Liq = np.zeros(test_delta.shape)
+    S2LiqV2 = np.zeros(test_delta.shape)
+    i = 0
+    for d in test_delta:
+        cash_cc = cash_min+d
+        S2Liq[i] = liquidation_price_quanto(L, pos, cash_cc, maintenance_margin_ratio,
+                    rho23, sigma2, sigma3, S2, S3)
+        S2LiqV2[i] = liquidation_price_quantoV2(L, pos, cash_cc, maintenance_margin_ratio,
+                    rho23, sigma2, sigma3, S2, S3)
+        print("cash = ", np.round(cash_cc, 5), 
+            ", cash delta = ", np.round(d, 4), 
+            " liq price = ", np.round(S2Liq, 4), 
+            " S2LiqV2=", np.round(S2LiqV2,4), " index price =", S2)
+        i += 1
+    return S2Liq, S2LiqV2
+
 def test_liq_price_quanto():
     L = 4000
     pos = 1
@@ -349,20 +440,8 @@ def test_liq_price_quanto():
     # cash that puts the position at maintenance margin rate
     cash_min = np.abs(pos)*maintenance_margin_ratio*S2ETHUSD/S3BTCUSD - (pos*S2ETHUSD-L)/S3BTCUSD
     test_delta = np.arange(-0.01, 0.11, 0.001) #[0.001, -0.001, 0, 0.1, 0.001]
-    S2Liq = np.zeros(test_delta.shape)
-    S2LiqV2 = np.zeros(test_delta.shape)
-    i = 0
-    for d in test_delta:
-        cash_cc = cash_min+d
-        S2Liq[i] = liquidation_price_quanto(L, pos, cash_cc, maintenance_margin_ratio,
-                    rho23, sigma2, sigma3, S2ETHUSD, S3BTCUSD)
-        S2LiqV2[i] = liquidation_price_quantoV2(L, pos, cash_cc, maintenance_margin_ratio,
+    S2Liq, S2LiqV2 = liq_price_quanto_sweep(cash_min, test_delta, L, pos, maintenance_margin_ratio,
                     rho23, sigma2, sigma3, S2ETHUSD, S3BTCUSD)
-        print("cash = ", np.round(cash_cc, 5), 
-            ", cash delta = ", np.round(d, 4), 
-            " liq price = ", np.round(S2Liq, 4), 
-            " S2LiqV2=", np.round(S2LiqV2,4), " index price =", S2ETHUSD)
-        i += 1
     #fig, axs = plot.subplots()
     plot.plot(cash_min+test_delta, S2Liq, label='rho')
     plot.plot(cash_min+test_delta, S2LiqV2, label='rho=1')
@@ -408,6 +487,26 @@ def test_insurance_fund_size():
                             s2, s3, currency_idx+1)
         print("istar for M",currency_idx+1,": ", i_star)
         
+@cached(depends=(mc_default_prob, prob_def_no_quanto))
+def pd_monte_carlo_sweep(k_vec, K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, seed=0):
+    """Monte Carlo and theoretical default probability after trades k_vec"""
+    # local generator: the global np.random state does not depend on cache hits
+    rng = np.random.default_rng(seed)
+    pd_mc = np.zeros(k_vec.shape)
+    pd_th = np.zeros(k_vec.shape)
+    dd_th = np.zeros(k_vec.shape)
+    idx = 0
+    for k in k_vec:
+        print(str(idx/k_vec.shape[0]*100)+"%")
+        pd_mc[idx] = mc_default_prob(K2+k, L1+s2*k, s2, s3, sig2, sig3, rho, r, M1, M2, M3, rng)
+        print('mc  : {:.17f}%'.format(pd_mc[idx]*100))
+        pd_th[idx],dd_th[idx] = prob_def_no_quanto(K2+k, L1+s2*k, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
+        print('th  : {:.17f}%'.format(pd_th[idx]*100))
+        print('diff: {:.17f}%'.format(100*(pd_mc[idx]-pd_th[idx])))
+        
+        idx += 1
+    return pd_mc, pd_th, dd_th
+
 def test_pd_monte_carlo():
     K2=2
     L1=2*46000
@@ -422,19 +521,7 @@ def test_pd_monte_carlo():
     s3 = 0
 
     k_vec = np.arange(-8, 8, 0.25)
-    pd_mc = np.zeros(k_vec.shape)
-    pd_th = np.zeros(k_vec.shape)
-    dd_th = np.zeros(k_vec.shape)
-    idx = 0
-    for k in k_vec:
-        print(str(idx/k_vec.shape[0]*100)+"%")
-        pd_mc[idx] = mc_default_prob(K2+k, L1+s2*k, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
-        print('mc  : {:.17f}%'.format(pd_mc[idx]*100))
-        pd_th[idx],dd_th[idx] = prob_def_no_quanto(K2+k, L1+s2*k, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
-        print('th  : {:.17f}%'.format(pd_th[idx]*100))
-        print('diff: {:.17f}%'.format(100*(pd_mc[idx]-pd_th[idx])))
-        
-        idx += 1
+    pd_mc, pd_th, dd_th = pd_monte_carlo_sweep(k_vec, K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
     
     fig, axs = plot.subplots(2)
     axs[0].plot(k_vec, 100*pd_mc, 'r:x', label='pd monte carlo')
@@ -450,6 +537,24 @@ def test_pd_monte_carlo():
     axs[1].legend()
     plot.show()
 
+@cached(depends=(calculate_perp_price, prob_def_no_quanto, numerical_sign))
+def pricing_curve_sweep(posvec, K2, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread):
+    """Price without and with minimal spread, distance to default and
+    numerical sign of the pricing curve for trade amounts posvec"""
+    pricevec = np.zeros(posvec.shape)
+    pricevec2 = np.zeros(posvec.shape)
+    ddvec = np.zeros(posvec.shape)
+    indvec2 = np.zeros(posvec.shape)
+    for j in range(posvec.shape[0]):
+        K = posvec[j]+K2
+        L = L1+posvec[j]*s2
+        k = posvec[j]
+        pricevec[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, 0)
+        pricevec2[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread)
+        p,ddvec[j] = prob_def_no_quanto(K, L, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
+        indvec2[j]=numerical_sign(K2, posvec[j], L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
+    return pricevec, pricevec2, ddvec, indvec2
+
 def test_case():
     """
     Assess specific AMM configuration
@@ -463,34 +568,17 @@ def test_case():
     M1, M3, r, sig3, rho, s3 = 0,0,0,0,0,0
     minSpread = 0.001
     posvec = np.arange(-0.12,0.008,0.0001)
-    pricevec = np.zeros(posvec.shape)
-    pricevec2 = np.zeros(posvec.shape)
-    pricevec3 = np.zeros(posvec.shape)
-    pricevec4 = np.zeros(posvec.shape)
-    ddvec = np.zeros(posvec.shape)
-    indvec = np.zeros(posvec.shape)
-    indvec2 = np.zeros(posvec.shape)
 
     u = -L1/s2 - M1/s2
     v = K2 - M2
     kStar = (u-v)/2
 
-    for j in range(posvec.shape[0]):
-        K = posvec[j]+K2
-        L = L1+posvec[j]*s2
-        k = posvec[j]
-        dir = np.sign(posvec[j])
-        #(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread=0.0001)
-        #K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread=0.0001
-        pricevec[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, 0)
-        pricevec2[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread)
-        pricevec3[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, 0)
-        
-        #pricevec2[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread, "numerical")
-        p,ddvec[j] = prob_def_no_quanto(K, L, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
-        #ddvec[j]=np.exp(ddvec[j]*sig2+(r-0.5*sig2**2))
-        indvec[j]=np.sign(posvec[j]-kStar)
-        indvec2[j]=numerical_sign(K2, posvec[j], L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
+    pricevec, pricevec2, ddvec, indvec2 = pricing_curve_sweep(posvec, K2, L1, s2, s3, sig2, sig3, rho, r,
+                                                               M1, M2, M3, minSpread)
+    pricevec3 = pricevec
+    pricevec4 = np.zeros(posvec.shape)
+    indvec = np.sign(posvec-kStar)
+    K = posvec[-1]+K2
     
     #whitepaper: pricingcurve.png
     fig, axs = plot.subplots(3, 1)
@@ -543,34 +631,18 @@ def binance_plot():
     M1, M3, r, sig3, rho, s3 = 0,0,0,0,0,0
     minSpread = 0.001
     posvec = np.arange(-0.12,0.008,0.0001)
-    pricevec = np.zeros(posvec.shape)
-    pricevec2 = np.zeros(posvec.shape)
-    pricevec3 = np.zeros(posvec.shape)
-    pricevec4 = np.zeros(posvec.shape)
-    ddvec = np.zeros(posvec.shape)
-    indvec = np.zeros(posvec.shape)
-    indvec2 = np.zeros(posvec.shape)
 
     #u = -L1/s2 - M1/s2
     #v = K2 - M2
     kStar = M2 - K2
 
-    for j in range(posvec.shape[0]):
-        K = posvec[j]+K2
-        L = L1+posvec[j]*s2
-        k = posvec[j]
-        dir = np.sign(posvec[j])
-        #(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread=0.0001)
-        pricevec[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, 0, 0)
-        pricevec2[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread, "numerical")
-        pricevec3[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, 0, "numerical")
-        pricevec4[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread, "numerical")
-        
-        #pricevec2[j] = calculate_perp_price(K2, k, L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3, minSpread, "numerical")
-        p,ddvec[j] = prob_def_no_quanto(K, L, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
-        #ddvec[j]=np.exp(ddvec[j]*sig2+(r-0.5*sig2**2))
-        indvec[j]=np.sign(posvec[j]-kStar)
-        indvec2[j]=numerical_sign(K2, posvec[j], L1, s2, s3, sig2, sig3, rho, r, M1, M2, M3)
+    # sign_type "numerical" has no effect in calculate_perp_price
+    pricevec, pricevec2, ddvec, indvec2 = pricing_curve_sweep(posvec, K2, L1, s2, s3, sig2, sig3, rho, r,
+                                                               M1, M2, M3, minSpread)
+    pricevec3 = pricevec
+    pricevec4 = pricevec2
+    indvec = np.sign(posvec-kStar)
+    K = posvec[-1]+K2
     
     #whitepaper: pricingcurve.png
     fig, axs = plot.subplots()
@@ -0,0 +1,356 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Asyncio quote server on top of the pricing functions of PricingBenchmark.py
+#
+# - index price ticks (s2, and s3 for quanto perpetuals where the collateral
+#   currency differs from base and quote currency) are pushed into a
+#   bounded queue (push_tick). While
+#   quote requests are outstanding, the tick consumer applies queued ticks
+#   at most once per quote batch, so under quoting load the queue fills up
+#   and the feed has to wait (backpressure); ticks that are queued for the
+#   same perpetual are conflated, only the latest s2 and s3 are applied
+# - quote requests (quote, or json lines over tcp) are collected and
+#   evaluated once per event loop iteration in one vectorized batch per
+#   perpetual. The number of outstanding requests is bounded by
+#   max_pending, further clients wait
+# - replay_feed replays PriceScenario.csv as a local price feed, load_test
+#   measures latency percentiles and throughput offline
+#
+# tcp protocol, one json object per line:
+#   request  {"perp": <id>, "k": <trade amount>}
+#   response {"price": .., "mid": .., "slippage": .., "pd": .., "dd": .., "s2": .., "s3": ..}
+#            non-finite values (e.g. dd without default risk) are null
+#   error    {"error": <message>}
+#
+# usage: python QuoteServer.py [num_clients] [requests_per_client] [tick_rate_hz]
+
+import sys
+import json
+import time
+import asyncio
+import numpy as np
+from PricingBenchmark import calculate_perp_price_vec, prob_def_no_quanto_vec, prob_def_quanto_vec
+from ScenarioReader import scenario_path, read_parameters, read_price_scenario, \
+    PARAMETERS_FILE_NAME, PRICE_SCENARIO_FILE_NAME
+
+def get_quotes(amm_state, k):
+    """Vectorized quotes for trade amounts k
+
+    Args:
+        amm_state (dict): keyword arguments of calculate_perp_price_vec except k
+        k (np.ndarray): trade amounts
+
+    Returns:
+        dict: price, mid price, slippage relative to mid, pd and dd after the trade
+    """
+    s = amm_state
+    price = calculate_perp_price_vec(k=k, **s)
+    mid = calculate_perp_price_vec(k=0, **dict(s, minSpread=0))
+    args = (s["s2"], s["s3"], s["sig2"], s["sig3"], s["rho"], s["r"], s["M1"], s["M2"])
+    if s["M3"] == 0:
+        pd, dd = prob_def_no_quanto_vec(s["K2"]+k, s["L1"]+k*s["s2"], *args, 0)
+    else:
+        pd, dd = prob_def_quanto_vec(s["K2"]+k, s["L1"]+k*s["s2"], *args, s["M3"])
+    return {"price": price, "mid": np.broadcast_to(mid, price.shape), "slippage": price/mid-1,
+            "pd": pd, "dd": dd}
+
+
+class QuoteServer:
+    """Keeps the AMM state per perpetual and serves quotes
+
+    Args:
+        perp_states (dict): perpetual id -> amm state (keyword arguments of
+            calculate_perp_price_vec except k)
+        max_pending (int): maximal number of outstanding quote requests
+        tick_queue_size (int): size of the index price tick queue
+    """
+    def __init__(self, perp_states, max_pending=10000, tick_queue_size=100):
+        self.states = {perp_id: dict(state) for perp_id, state in perp_states.items()}
+        self.max_pending = max_pending
+        self.tick_queue_size = tick_queue_size
+        self.pending = []
+        self.flush_scheduled = False
+        self.num_batches = 0
+        self.num_quotes = 0
+        self.num_ticks = 0
+        self.num_conflated = 0
+        self.ticks = None
+        self.slots = None
+        self.flushed = None
+
+    def _init_loop_objects(self):
+        # asyncio objects are created in the running loop
+        if self.ticks is None:
+            self.ticks = asyncio.Queue(self.tick_queue_size)
+            self.slots = asyncio.Semaphore(self.max_pending)
+            self.flushed = asyncio.Event()
+
+    async def push_tick(self, perp_id, s2, s3=None):
+        """Feed side: waits while the tick queue is full
+
+        Args:
+            perp_id: perpetual id
+            s2 (float): index price
+            s3 (float): collateral currency index price of a quanto
+                perpetual, None if unchanged
+        """
+        self._init_loop_objects()
+        await self.ticks.put((perp_id, s2, s3))
+
+    async def consume_ticks(self):
+        self._init_loop_objects()
+        while True:
+            if len(self.pending) > 0:
+                # quotes first: one tick update per quote batch
+                self.flushed.clear()
+                await self.flushed.wait()
+            ticks = [await self.ticks.get()]
+            while not self.ticks.empty():
+                ticks.append(self.ticks.get_nowait())
+            # ticks queued before the stop marker are still applied
+            is_stop = (None, None, None) in ticks
+            if is_stop:
+                ticks = ticks[:ticks.index((None, None, None))]
+            latest = dict()
+            for perp_id, s2, s3 in ticks:
+                update = latest.setdefault(perp_id, dict())
+                update["s2"] = s2
+                if s3 is not None:
+                    update["s3"] = s3
+            for perp_id, update in latest.items():
+                self.states[perp_id].update(update)
+            self.num_ticks += len(ticks)
+            self.num_conflated += len(ticks) - len(latest)
+            if is_stop:
+                return
+
+    async def stop_ticks(self):
+        await self.push_tick(None, None, None)
+
+    async def quote(self, perp_id, k):
+        """Quote for trade amount k, evaluated with all other requests of
+        the same event loop iteration
+
+        Returns:
+            dict: price, mid, slippage, pd, dd, s2 and s3 of the quote
+        """
+        self._init_loop_objects()
+        if perp_id not in self.states:
+            raise KeyError("unknown perpetual " + str(perp_id))
+        async with self.slots:
+            fut = asyncio.get_running_loop().create_future()
+            self.pending.append((perp_id, k, fut))
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                asyncio.get_running_loop().call_soon(self._flush)
+            return await fut
+
+    def _flush(self):
+        batch, self.pending = self.pending, []
+        self.flush_scheduled = False
+        self.num_batches += 1
+        self.num_quotes += len(batch)
+        if self.flushed is not None:
+            self.flushed.set()
+        by_perp = dict()
+        for j, (perp_id, _, _) in enumerate(batch):
+            by_perp.setdefault(perp_id, []).append(j)
+        for perp_id, idx in by_perp.items():
+            if perp_id not in self.states:
+                for j in idx:
+                    batch[j][2].set_exception(KeyError("unknown perpetual " + str(perp_id)))
+                continue
+            state = self.states[perp_id]
+            k = np.array([batch[j][1] for j in idx], dtype=float)
+            try:
+                res = get_quotes(state, k)
+            except Exception as e:
+                # fail the requests of this perpetual instead of leaving them waiting
+                for j in idx:
+                    if not batch[j][2].done():
+                        batch[j][2].set_exception(e)
+                continue
+            # json has no nan/inf
+            res = {key: np.where(np.isfinite(val), val, None).tolist() for key, val in res.items()}
+            for i, j in enumerate(idx):
+                fut = batch[j][2]
+                if not fut.cancelled():
+                    quote = {key: val[i] for key, val in res.items()}
+                    quote["s2"], quote["s3"] = state["s2"], state["s3"]
+                    fut.set_result(quote)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    req = json.loads(line)
+                    if not isinstance(req, dict):
+                        raise ValueError("request is not a json object")
+                    perp_id, k = req["perp"], float(req["k"])
+                    if not np.isfinite(k):
+                        raise ValueError("trade amount is not finite")
+                except (ValueError, KeyError, TypeError) as e:
+                    resp = {"error": "invalid request: " + repr(e)}
+                else:
+                    try:
+                        resp = await self.quote(perp_id, k)
+                    except Exception as e:
+                        resp = {"error": repr(e)}
+                writer.write((json.dumps(resp) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start the tcp server and the tick consumer
+
+        Returns:
+            asyncio.Server: server, the port is in server.sockets[0].getsockname()
+        """
+        self._init_loop_objects()
+        self.tick_task = asyncio.ensure_future(self.consume_ticks())
+        return await asyncio.start_server(self.handle_client, host, port)
+
+
+def amm_state_from_scenario(scenario="scenario1"):
+    # AMM state with the perpetual parameters of IntegrationTestParameters.csv
+    params = read_parameters(scenario_path(scenario, PARAMETERS_FILE_NAME))
+    _, prices = read_price_scenario(scenario_path(scenario, PRICE_SCENARIO_FILE_NAME))
+    s2 = prices[0]
+    K2 = params["amm_min_size"]
+    return dict(K2=K2, L1=K2*s2, s2=s2, s3=s2, sig2=params["sig2"], sig3=params["sig3"],
+                rho=params["rho23"], r=params["r"], M1=0, M2=params["initial_amm_cash"], M3=0,
+                minSpread=params["fMinimalSpread"])
+
+async def replay_feed(server, perp_id, prices, rate_hz, num_ticks):
+    """Push num_ticks index prices (cycling through prices) at rate_hz"""
+    t0 = time.perf_counter()
+    for j in range(num_ticks):
+        await server.push_tick(perp_id, float(prices[j % len(prices)]))
+        wait = t0 + (j+1)/rate_hz - time.perf_counter()
+        # behind schedule: still yield to the quoting tasks
+        await asyncio.sleep(max(wait, 0))
+
+async def _client(host, port, perp_id, k_values, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    for k in k_values:
+        t0 = time.perf_counter()
+        writer.write((json.dumps({"perp": perp_id, "k": k}) + "\n").encode())
+        await writer.drain()
+        resp = json.loads(await reader.readline())
+        latencies.append(time.perf_counter()-t0)
+        assert("price" in resp)
+    writer.close()
+
+async def load_test(num_clients=100, requests_per_client=200, tick_rate_hz=1000, scenario="scenario1"):
+    """Offline load test: replay feed and tcp clients against one server
+
+    Returns:
+        dict: latency percentiles (ms), throughput (quotes/s) and server stats
+    """
+    perp_id = 0
+    state = amm_state_from_scenario(scenario)
+    _, prices = read_price_scenario(scenario_path(scenario, PRICE_SCENARIO_FILE_NAME))
+    quote_server = QuoteServer({perp_id: state})
+    server = await quote_server.start()
+    host, port = server.sockets[0].getsockname()[:2]
+    rng = np.random.default_rng(0)
+    latencies = []
+    t0 = time.perf_counter()
+    feed = asyncio.ensure_future(replay_feed(quote_server, perp_id, prices, tick_rate_hz, 10**9))
+    clients = [_client(host, port, perp_id, rng.normal(0, 0.5, requests_per_client).tolist(), latencies)
+               for _ in range(num_clients)]
+    await asyncio.gather(*clients)
+    duration = time.perf_counter()-t0
+    feed.cancel()
+    await quote_server.stop_ticks()
+    await quote_server.tick_task
+    server.close()
+    await server.wait_closed()
+    lat = 1000*np.array(latencies)
+    return {"p50": np.percentile(lat, 50), "p90": np.percentile(lat, 90), "p99": np.percentile(lat, 99),
+            "max": np.max(lat), "throughput": len(latencies)/duration,
+            "avg_batch": quote_server.num_quotes/quote_server.num_batches,
+            "ticks": quote_server.num_ticks, "conflated_ticks": quote_server.num_conflated}
+
+def test_quote_batching():
+    # quotes of one batch equal the scalar pricing of calculate_perp_price
+    from PricingBenchmark import calculate_perp_price
+    state = amm_state_from_scenario()
+    quote_server = QuoteServer({0: state})
+    k_values = [-0.5, -0.01, 0, 0.01, 0.5]
+    async def run():
+        return await asyncio.gather(*[quote_server.quote(0, k) for k in k_values])
+    quotes = asyncio.run(run())
+    assert(quote_server.num_batches == 1)
+    for k, q in zip(k_values, quotes):
+        px = calculate_perp_price(state["K2"], k, state["L1"], state["s2"], state["s3"], state["sig2"],
+            state["sig3"], state["rho"], state["r"], state["M1"], state["M2"], state["M3"], state["minSpread"])
+        assert(np.abs(q["price"] - px) < 1e-9*px)
+
+def test_quanto_ticks():
+    # s3 ticks of a quanto perpetual reach the quotes, ticks without s3 keep it
+    from PricingBenchmark import calculate_perp_price
+    state = dict(amm_state_from_scenario(), M3=0.04)
+    quote_server = QuoteServer({0: state})
+    s2, s3 = state["s2"]*1.01, state["s3"]*1.2
+    async def run():
+        consumer = asyncio.ensure_future(quote_server.consume_ticks())
+        await quote_server.push_tick(0, state["s2"], s3)
+        await quote_server.push_tick(0, s2)
+        await quote_server.stop_ticks()
+        await consumer
+        return await quote_server.quote(0, 0.1)
+    q = asyncio.run(run())
+    assert(q["s2"] == s2 and q["s3"] == s3)
+    px = calculate_perp_price(state["K2"], 0.1, state["L1"], s2, s3, state["sig2"], state["sig3"], state["rho"],
+                              state["r"], state["M1"], state["M2"], state["M3"], state["minSpread"])
+    assert(np.abs(q["price"] - px) < 1e-9*px)
+
+def _no_constant(name):
+    raise ValueError("invalid json constant " + name)
+
+def test_error_replies():
+    # malformed requests and failing evaluations get an error reply, nothing hangs
+    state = amm_state_from_scenario()
+    # M3 missing: get_quotes fails for perpetual 1
+    quote_server = QuoteServer({0: state, 1: {key: val for key, val in state.items() if key != "M3"}})
+    async def run():
+        server = await quote_server.start()
+        host, port = server.sockets[0].getsockname()[:2]
+        reader, writer = await asyncio.open_connection(host, port)
+        replies = []
+        for line in ("[1, 2]", "3", "not json", '{"perp": 0}', '{"perp": 0, "k": NaN}', '{"perp": 0, "k": "x"}', '{"perp": [0], "k": 1}',
+                     '{"perp": 7, "k": 1}', '{"perp": 1, "k": 1}', '{"perp": 0, "k": 0.1}'):
+            writer.write((line + "\n").encode())
+            await writer.drain()
+            replies.append(json.loads(await asyncio.wait_for(reader.readline(), 5), parse_constant=_no_constant))
+        writer.close()
+        await quote_server.stop_ticks()
+        await quote_server.tick_task
+        server.close()
+        await server.wait_closed()
+        return replies
+    replies = asyncio.run(run())
+    assert(all("error" in r for r in replies[:-1]) and "price" in replies[-1])
+    # non-finite results are null
+    quote = asyncio.run(QuoteServer({0: state}).quote(0, float("nan")))
+    assert(quote["price"] is None and quote["dd"] is None)
+    json.loads(json.dumps(quote), parse_constant=_no_constant)
+
+if __name__ == "__main__":
+    num_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    requests_per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    tick_rate_hz = float(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    test_quote_batching()
+    test_quanto_ticks()
+    test_error_replies()
+    res = asyncio.run(load_test(num_clients, requests_per_client, tick_rate_hz))
+    print("latency p50 = {:.3f}ms, p90 = {:.3f}ms, p99 = {:.3f}ms, max = {:.3f}ms".format(
+        res["p50"], res["p90"], res["p99"], res["max"]))
+    print("throughput = {:.0f} quotes/s, average batch size = {:.1f}".format(res["throughput"], res["avg_batch"]))
+    print("ticks applied = {}, conflated = {}".format(res["ticks"], res["conflated_ticks"]))
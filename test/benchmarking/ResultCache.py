@@ -0,0 +1,374 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Content addressed on-disk cache for the results of expensive sweeps and
+# studies (e.g. the sweeps behind test_pd_monte_carlo or test_case in
+# PricingBenchmark.py), so that re-running a study with changed plotting
+# does not recompute its data.
+#
+# The key of a result is the sha256 hash of
+#   - the module and qualified name of the function
+#   - the arguments after binding them to the signature (defaults applied),
+#     numpy arrays are hashed by dtype, shape and content
+#   - the code version: source code of the function and of the functions
+#     in depends, and transitively of the functions they reference by
+#     global name that are defined in the same directory (so a sweep picks
+#     up its helpers, e.g. calculate_perp_price -> prob_def_quanto), plus
+#     the values of referenced module constants (numbers, strings, tuples,
+#     arrays); for modules in depends the content of their source file
+# Edits elsewhere in the same file, e.g. in the plotting code of a study,
+# keep the cached results. Code reached only through objects that are not
+# functions (classes, methods, attributes of modules) is not tracked, add
+# such modules to depends.
+#
+# Results are numpy arrays, or tuples/lists/dicts of numpy arrays (scalars
+# are stored as 0-d arrays). Each entry is a directory <key> with meta.json
+# and the arrays as .npy files, which are returned as read-only memory maps,
+# or with compress=True as one compressed data.npz. Entries are written to a
+# temporary directory and renamed, so concurrent runs never see partial
+# results. When the total size exceeds max_bytes, the least recently used
+# entries are removed (a cache hit updates the modification time of meta.json).
+#
+# Setting the environment variable RESULT_CACHE=0 disables the cache.
+#
+# usage:
+#   @cached
+#   def sweep(k_vec, sig2): ...
+#
+#   @cached(compress=True, depends=(test_liquidations, mc_default_prob))
+#   def study(...): ...
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import functools
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".result_cache")
+MAX_CACHE_BYTES = 2*1024**3
+META_FILE_NAME = "meta.json"
+
+def _update_hash(h, obj):
+    # canonical encoding of call arguments
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            raise TypeError("cannot hash object arrays")
+        h.update(("nd" + obj.dtype.str + str(obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif obj is None or isinstance(obj, (bool, np.bool_)):
+        h.update(("c" + repr(obj if obj is None else bool(obj))).encode())
+    elif isinstance(obj, (int, np.integer)):
+        h.update(("i" + repr(int(obj))).encode())
+    elif isinstance(obj, (float, np.floating)):
+        h.update(("f" + repr(float(obj))).encode())
+    elif isinstance(obj, str):
+        h.update(("s" + str(len(obj)) + ":" + obj).encode())
+    elif isinstance(obj, (tuple, list)):
+        h.update(("l" + str(len(obj))).encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, dict):
+        h.update(("d" + str(len(obj))).encode())
+        for key in sorted(obj, key=str):
+            _update_hash(h, str(key))
+            _update_hash(h, obj[key])
+    else:
+        raise TypeError("cannot hash argument of type " + type(obj).__name__)
+
+def _to_arrays(result):
+    # result -> (kind, names, arrays)
+    if isinstance(result, dict):
+        names = [str(key) for key in result]
+        return "dict", names, [np.asarray(result[key]) for key in result]
+    if isinstance(result, (tuple, list)):
+        return "tuple", [str(j) for j in range(len(result))], [np.asarray(x) for x in result]
+    return "array", ["0"], [np.asarray(result)]
+
+def _from_arrays(kind, names, arrays):
+    if kind == "dict":
+        return dict(zip(names, arrays))
+    if kind == "tuple":
+        return tuple(arrays)
+    return arrays[0]
+
+def _code_names(code):
+    # global names used by a code object and its nested functions/comprehensions
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+def _is_constant(value):
+    if isinstance(value, (bool, int, float, str, np.integer, np.floating)):
+        return True
+    if isinstance(value, tuple):
+        return all(_is_constant(v) for v in value)
+    return isinstance(value, np.ndarray) and not value.dtype.hasobject
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+class ResultCache:
+    """On-disk cache of function results, see module description
+
+    Args:
+        cache_dir (str): directory of the entries
+        max_bytes (int): maximal total size, least recently used entries
+            are removed above
+        compress (bool): default storage, compressed npz (True) or memory
+            mapped npy files (False)
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, compress=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.num_hits = 0
+        self.num_misses = 0
+        self._file_hashes = dict()
+        self._sources = dict()
+        self._code_versions = dict()
+
+    def _file_hash(self, filename):
+        # hashed once per process
+        if filename not in self._file_hashes:
+            with open(filename, "rb") as f:
+                self._file_hashes[filename] = hashlib.sha256(f.read()).hexdigest()
+        return self._file_hashes[filename]
+
+    def code_version(self, func, depends=()):
+        """Hash of the code of func and depends, see module description"""
+        if (func, depends) not in self._code_versions:
+            self._code_versions[(func, depends)] = self._code_version(func, depends)
+        return self._code_versions[(func, depends)]
+
+    def _code_version(self, func, depends):
+        h = hashlib.sha256()
+        root = os.path.dirname(os.path.abspath(inspect.getsourcefile(func)))
+        seen = set()
+        todo = [func] + [m for m in depends if not inspect.ismodule(m)]
+        while len(todo) > 0:
+            f = inspect.unwrap(todo.pop())
+            if f in seen:
+                continue
+            seen.add(f)
+            _update_hash(h, f.__module__ + "." + f.__qualname__)
+            _update_hash(h, self._function_source(f))
+            for name in sorted(_code_names(f.__code__)):
+                value = f.__globals__.get(name)
+                if inspect.isfunction(value):
+                    source_file = inspect.getsourcefile(inspect.unwrap(value))
+                    if source_file is not None and os.path.dirname(os.path.abspath(source_file)) == root:
+                        todo.append(value)
+                elif _is_constant(value):
+                    _update_hash(h, [name, value])
+        files = [inspect.getsourcefile(m) for m in depends if inspect.ismodule(m)]
+        _update_hash(h, [self._file_hash(os.path.abspath(f)) for f in files])
+        return h.hexdigest()
+
+    def _function_source(self, func):
+        # read once per process
+        if func not in self._sources:
+            self._sources[func] = inspect.getsource(func)
+        return self._sources[func]
+
+    def key(self, func, args, kwargs, depends=()):
+        """Key of the call func(*args, **kwargs)"""
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        h = hashlib.sha256()
+        _update_hash(h, func.__module__ + "." + func.__qualname__)
+        _update_hash(h, self.code_version(func, depends))
+        _update_hash(h, dict(bound.arguments))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Cached result of key
+
+        Returns:
+            (bool, object): found flag and result (arrays as read-only memory
+                maps unless the entry is compressed)
+        """
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(path, META_FILE_NAME)) as f:
+                meta = json.load(f)
+            if meta["compressed"]:
+                with np.load(os.path.join(path, "data.npz")) as data:
+                    arrays = [data[name] for name in meta["names"]]
+            else:
+                arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in meta["names"]]
+            os.utime(os.path.join(path, META_FILE_NAME))
+        except (OSError, ValueError, KeyError):
+            # missing, evicted meanwhile or incomplete entry
+            return False, None
+        return True, _from_arrays(meta["kind"], meta["names"], arrays)
+
+    def put(self, key, result, compress=None, func_name=""):
+        """Store the result of key and evict old entries"""
+        compress = self.compress if compress is None else compress
+        kind, names, arrays = _to_arrays(result)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = path + ".tmp" + str(os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        if compress:
+            np.savez_compressed(os.path.join(tmp_path, "data.npz"), **dict(zip(names, arrays)))
+        else:
+            for name, a in zip(names, arrays):
+                np.save(os.path.join(tmp_path, name + ".npy"), a, allow_pickle=False)
+        meta = {"function": func_name, "kind": kind, "names": names, "compressed": compress,
+                "created": time.time()}
+        with open(os.path.join(tmp_path, META_FILE_NAME), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # stored by a concurrent run
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entries(self):
+        """List of (key, last access time, size in bytes), oldest first"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        res = []
+        for key in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, key)
+            meta_file = os.path.join(path, META_FILE_NAME)
+            if ".tmp" in key or not os.path.exists(meta_file):
+                continue
+            try:
+                res.append((key, os.path.getmtime(meta_file), _dir_size(path)))
+            except OSError:
+                continue
+        return sorted(res, key=lambda e: e[1])
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the size is below max_bytes"""
+        entries = self.entries()
+        total = sum(e[2] for e in entries)
+        for key, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def cached(self, func=None, depends=(), compress=None):
+        """Decorator, returns cached results of func for equal arguments and code
+
+        Args:
+            func (callable): function with hashable arguments (numbers,
+                strings, numpy arrays, tuples/lists/dicts of these)
+            depends (tuple): functions whose code (and transitively the code
+                of the functions they call) is part of the code version, and
+                modules whose whole source file is
+            compress (bool): storage of the results, None: cache default
+        """
+        if func is None:
+            return lambda f: self.cached(f, depends, compress)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if os.environ.get("RESULT_CACHE", "1") == "0":
+                return func(*args, **kwargs)
+            key = self.key(func, args, kwargs, depends)
+            found, result = self.get(key)
+            if found:
+                self.num_hits += 1
+                return result
+            self.num_misses += 1
+            result = func(*args, **kwargs)
+            self.put(key, result, compress, func.__module__ + "." + func.__qualname__)
+            # return what later calls will get
+            found, cached_result = self.get(key)
+            return cached_result if found else result
+        wrapper.cache = self
+        return wrapper
+
+
+default_cache = ResultCache()
+
+def cached(func=None, depends=(), compress=None):
+    """Decorator using default_cache, see ResultCache.cached"""
+    return default_cache.cached(func, depends, compress)
+
+def test_result_cache():
+    import tempfile
+    cache = ResultCache(tempfile.mkdtemp(), max_bytes=3*8*10**5 + 10**4)
+    num_calls = [0]
+    @cache.cached
+    def sweep(x, scale=2.0):
+        num_calls[0] += 1
+        return {"y": scale*x, "n": x.shape[0]}
+    @cache.cached(compress=True)
+    def sweep_pair(x):
+        num_calls[0] += 1
+        return x+1, x-1
+    x = np.arange(10**5, dtype=float)
+    a = sweep(x)
+    b = sweep(x, 2.0)
+    c = sweep(x=x)
+    assert(num_calls[0] == 1 and cache.num_hits == 2)
+    assert(np.array_equal(a["y"], 2*x) and np.array_equal(c["y"], b["y"]) and int(a["n"]) == 10**5)
+    sweep(x, 3.0)
+    assert(num_calls[0] == 2)
+    p, m = sweep_pair(x)
+    p, m = sweep_pair(x)
+    assert(num_calls[0] == 3 and np.array_equal(p, x+1))
+    # fourth array entry exceeds max_bytes: least recently used entries go
+    sweep(x+1)
+    assert(len(cache.entries()) <= 3)
+    cache.clear()
+
+def _load_module(path, name):
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_code_version():
+    # edits outside a sweep and its helpers keep the key, edits of helpers change it
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    helper = "SCALE = 2.0\n\ndef helper(x):\n    return SCALE*x\n"
+    sweep = "from cv_helper import helper\n\ndef sweep(x):\n    return [helper(v) for v in x]\n"
+    plotting = "\ndef plot_sweep():\n    print(sweep([1]))\n"
+    versions = []
+    for j, (h, p) in enumerate(((helper, plotting), (helper, plotting + "# comment\n"),
+                                (helper.replace("2.0", "3.0"), plotting), (helper + "\n", plotting),
+                                (helper.replace("SCALE*x", "x*SCALE"), plotting))):
+        with open(os.path.join(tmp_dir, "cv_helper.py"), "w") as f:
+            f.write(h)
+        with open(os.path.join(tmp_dir, "cv_sweep.py"), "w") as f:
+            f.write(sweep + p)
+        sys.path.insert(0, tmp_dir)
+        try:
+            sys.modules.pop("cv_helper", None)
+            module = _load_module(os.path.join(tmp_dir, "cv_sweep.py"), "cv_sweep")
+        finally:
+            sys.path.remove(tmp_dir)
+        versions.append(ResultCache(tmp_dir).code_version(module.sweep))
+    # plotting edit, constant, unrelated edit, helper code
+    assert(versions[1] == versions[0] and versions[2] != versions[0] and versions[3] == versions[0])
+    assert(versions[4] != versions[0])
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    test_result_cache()
+    test_code_version()
+    # cache content; argument "clear" removes all entries
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        default_cache.clear()
+    entries = default_cache.entries()
+    print(len(entries), "entries,", np.round(sum(e[2] for e in entries)/1024**2, 2), "MB in", default_cache.cache_dir)
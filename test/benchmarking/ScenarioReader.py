@@ -0,0 +1,44 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Python counterpart of test/test_scenarios/TestScenarioReader.ts
+
+import os
+import csv
+import numpy as np
+
+SCENARIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test_scenarios")
+PARAMETERS_FILE_NAME = "IntegrationTestParameters.csv"
+PRICE_SCENARIO_FILE_NAME = "PriceScenario.csv"
+
+def scenario_path(scenario, filename):
+    return os.path.join(SCENARIO_DIR, scenario, filename)
+
+def read_parameters(filename):
+    """Read IntegrationTestParameters.csv
+
+    Args:
+        filename (str): path to the csv file
+
+    Returns:
+        dict: parameter_name -> value1, or (value1, value2) if value2 is set
+    """
+    params = dict()
+    with open(filename, newline="") as f:
+        for row in csv.DictReader(f):
+            value1 = float(row["value1"])
+            value2 = row["value2"].strip() if row["value2"] is not None else ""
+            params[row["parameter_name"]] = (value1, float(value2)) if value2 != "" else value1
+    return params
+
+def read_price_scenario(filename):
+    """Read PriceScenario.csv
+
+    Args:
+        filename (str): path to the csv file
+
+    Returns:
+        (np.ndarray, np.ndarray): ids and index prices
+    """
+    data = np.loadtxt(filename, delimiter=",", skiprows=1, ndmin=2)
+    return data[:, 0].astype(np.int64), data[:, 1]
@@ -0,0 +1,318 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Streaming estimation of the stress returns r2pair/r3pair used by
+# get_DF_target_size (and stress_return_S2/S3 in IntegrationTestParameters.csv)
+# from long price histories.
+#
+# Log-returns over several horizons are collected per market in quantile
+# sketches with logarithmic buckets (as DDSketch): a value x != 0 falls into
+# bucket ceil(log(|x|)/log(gamma)), gamma = (1+alpha)/(1-alpha), separately
+# for positive and negative values. Every quantile is returned with a
+# relative error of at most alpha (within [MIN_ABS_RETURN, MAX_ABS_RETURN]),
+# which is what matters for tail quantiles. The bucket range is fixed, so
+# the memory is bounded and independent of the history length, and two
+# sketches are merged by adding their bucket counts. This allows parallel
+# ingestion of files or file parts followed by a merge step.
+#
+# usage: python StressQuantiles.py [price_file.csv ...]
+#   csv files in the format of PriceScenario.csv (id,priceIndex), markets
+#   are keyed by the file path (all scenarios use the file name
+#   PriceScenario.csv); without files a synthetic history is used (written
+#   to synthetic_prices.csv in the temp directory, reused if it is complete)
+
+import os
+import sys
+import time
+import tempfile
+import warnings
+import numpy as np
+from multiprocessing import Pool
+from ScenarioReader import scenario_path, PRICE_SCENARIO_FILE_NAME
+
+# |log-returns| below MIN_ABS_RETURN are counted as 0, above MAX_ABS_RETURN
+# they are counted in the last bucket
+MIN_ABS_RETURN = 1e-8
+MAX_ABS_RETURN = 10
+
+class ReturnSketch:
+    """Mergeable quantile sketch with relative accuracy alpha
+
+    Args:
+        alpha (float): relative accuracy of the quantiles
+    """
+    def __init__(self, alpha=0.005):
+        self.alpha = alpha
+        self.log_gamma = np.log((1+alpha)/(1-alpha))
+        self.min_key = int(np.ceil(np.log(MIN_ABS_RETURN)/self.log_gamma))
+        self.max_key = int(np.ceil(np.log(MAX_ABS_RETURN)/self.log_gamma))
+        num_keys = self.max_key - self.min_key + 1
+        self.pos = np.zeros(num_keys, dtype=np.int64)
+        self.neg = np.zeros(num_keys, dtype=np.int64)
+        self.num_zero = 0
+        self.count = 0
+
+    def add(self, x):
+        """Add an array of values"""
+        x = np.asarray(x, dtype=float).reshape(-1)
+        x = x[np.isfinite(x)]
+        a = np.abs(x)
+        is_zero = a < MIN_ABS_RETURN
+        with np.errstate(divide='ignore'):
+            key = np.ceil(np.log(a)/self.log_gamma)
+        key = (np.clip(key, self.min_key, self.max_key) - self.min_key).astype(np.int64)
+        n = self.pos.shape[0]
+        self.pos += np.bincount(key[(x > 0) & ~is_zero], minlength=n)
+        self.neg += np.bincount(key[(x < 0) & ~is_zero], minlength=n)
+        self.num_zero += int(np.sum(is_zero))
+        self.count += x.shape[0]
+
+    def merge(self, other):
+        """Add the counts of another sketch with the same accuracy"""
+        assert(self.alpha == other.alpha)
+        self.pos += other.pos
+        self.neg += other.neg
+        self.num_zero += other.num_zero
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """Quantiles of the values added so far
+
+        Args:
+            q (float or array): probabilities in [0, 1]
+
+        Returns:
+            np.ndarray: quantiles (nan if the sketch is empty)
+        """
+        q = np.asarray(q, dtype=float)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        keys = np.arange(self.min_key, self.max_key + 1)
+        value = 2*np.exp(keys*self.log_gamma)/(1 + np.exp(self.log_gamma))
+        # all buckets in increasing order: negative (largest |x| first), zero, positive
+        values = np.concatenate((-value[::-1], [0], value))
+        counts = np.concatenate((self.neg[::-1], [self.num_zero], self.pos))
+        # linear interpolation between the values of the neighbouring ranks
+        # (as np.quantile), the lower rank alone biases upper quantiles low
+        cum_counts = np.cumsum(counts)
+        def value_at(rank):
+            idx = np.searchsorted(cum_counts, rank, side="right")
+            return values[np.minimum(idx, values.shape[0]-1)]
+        rank = q*(self.count - 1)
+        lo = np.floor(rank)
+        v_lo, v_hi = value_at(lo), value_at(np.ceil(rank))
+        return v_lo + (rank - lo)*(v_hi - v_lo)
+
+
+class MultiHorizonReturns:
+    """Sketches of log-returns over several horizons for one market
+
+    Prices are streamed in chunks (add_prices); the last max(horizons)
+    prices are kept so that returns spanning chunk boundaries are counted.
+
+    Args:
+        horizons (list): return horizons in number of ticks
+        alpha (float): relative accuracy of the quantiles
+    """
+    def __init__(self, horizons=(1,), alpha=0.005):
+        self.horizons = tuple(int(h) for h in horizons)
+        self.sketches = {h: ReturnSketch(alpha) for h in self.horizons}
+        self.tail = np.zeros(0)
+
+    def add_prices(self, prices):
+        log_px = np.concatenate((self.tail, np.log(np.asarray(prices, dtype=float))))
+        for h in self.horizons:
+            if log_px.shape[0] > h:
+                # returns that end in the new chunk
+                start = max(h, self.tail.shape[0])
+                self.sketches[h].add(log_px[start:] - log_px[start-h:-h])
+        self.tail = log_px[-max(self.horizons):]
+
+    def merge(self, other):
+        # merges the return counts; returns spanning both histories are not
+        # counted, split long histories with an overlap of max(horizons) ticks
+        for h in self.horizons:
+            self.sketches[h].merge(other.sketches[h])
+        return self
+
+    def stress_returns(self, horizon, q_low=0.001, q_high=0.999):
+        """Lower and upper stress log-return as used for r2pair/r3pair
+        in get_DF_target_size
+
+        Returns:
+            np.ndarray: [lower, upper]
+        """
+        return self.sketches[horizon].quantile(np.array([q_low, q_high]))
+
+
+def _read_rows(f, max_rows):
+    # loadtxt warns at the end of the file
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return np.loadtxt(f, delimiter=",", max_rows=max_rows, ndmin=2)
+
+def ingest_price_file(filename, horizons=(1,), alpha=0.005, chunk_rows=1000000, skip_rows=0, max_rows=None,
+                      warmup_rows=0):
+    """Stream a price file (format of PriceScenario.csv) into sketches
+
+    Args:
+        filename (str): csv file with header and columns id, priceIndex
+        horizons (list): return horizons in ticks
+        alpha (float): relative accuracy
+        chunk_rows (int): rows read per chunk
+        skip_rows (int): data rows to skip (for parallel ingestion of file parts)
+        max_rows (int): maximal number of data rows to read after the
+            warmup rows (None: all)
+        warmup_rows (int): rows after skip_rows that only start returns,
+            returns ending in them are not counted
+
+    Returns:
+        MultiHorizonReturns: sketches of the file
+    """
+    mhr = MultiHorizonReturns(horizons, alpha)
+    num_read = 0
+    with open(filename) as f:
+        f.readline()
+        for _ in range(skip_rows):
+            f.readline()
+        if warmup_rows > 0:
+            data = _read_rows(f, warmup_rows)
+            mhr.tail = np.log(data[-max(mhr.horizons):, 1])
+        while max_rows is None or num_read < max_rows:
+            n = chunk_rows if max_rows is None else min(chunk_rows, max_rows - num_read)
+            data = _read_rows(f, n)
+            if data.shape[0] == 0:
+                break
+            mhr.add_prices(data[:, 1])
+            num_read += data.shape[0]
+            if data.shape[0] < n:
+                break
+    return mhr
+
+def _ingest_part(args):
+    return ingest_price_file(*args)
+
+def ingest_parallel(filename, num_rows, num_parts, horizons=(1,), alpha=0.005, processes=None):
+    """Ingest one long price file in num_parts parallel parts and merge
+
+    Each part reads the max(horizons) ticks before it as warmup, so that
+    every return is counted exactly once, in the part where it ends.
+
+    Args:
+        filename (str): price file
+        num_rows (int): number of data rows of the file
+        num_parts (int): number of parts
+        horizons (list): return horizons in ticks
+        alpha (float): relative accuracy
+        processes (int): number of worker processes (None: cpu count)
+
+    Returns:
+        MultiHorizonReturns: merged sketches
+    """
+    overlap = max(horizons)
+    bounds = np.linspace(0, num_rows, num_parts+1).astype(int)
+    jobs = []
+    for j in range(num_parts):
+        warmup = min(overlap, bounds[j])
+        jobs.append((filename, horizons, alpha, 1000000, bounds[j]-warmup, bounds[j+1]-bounds[j], warmup))
+    with Pool(processes) as pool:
+        parts = pool.map(_ingest_part, jobs)
+    result = parts[0]
+    for part in parts[1:]:
+        result.merge(part)
+    return result
+
+def synthetic_price_file(filename, num_ticks, seed=0):
+    # fat-tailed random walk in the format of PriceScenario.csv, written to
+    # a temporary file first so that an interrupted run leaves no partial file
+    rng = np.random.default_rng(seed)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write("id,priceIndex\n")
+        px = 40000.0
+        for start in range(0, num_ticks, 1000000):
+            n = min(1000000, num_ticks - start)
+            r = 0.001*rng.standard_t(3, n)
+            prices = px*np.exp(np.cumsum(r))
+            px = prices[-1]
+            ids = np.arange(start, start+n)
+            np.savetxt(f, np.column_stack((ids, prices)), delimiter=",", fmt=("%d", "%.6f"))
+    os.replace(tmp_filename, filename)
+
+def num_data_rows(filename):
+    # number of complete data rows (lines after the header)
+    num_lines = 0
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            num_lines += block.count(b"\n")
+    return num_lines - 1
+
+def test_sketch_accuracy():
+    rng = np.random.default_rng(1)
+    x = 0.01*rng.standard_t(3, 2000000)
+    sk1, sk2 = ReturnSketch(0.005), ReturnSketch(0.005)
+    sk1.add(x[:1000000])
+    sk2.add(x[1000000:])
+    sk1.merge(sk2)
+    q = np.array([0.0001, 0.001, 0.01, 0.5, 0.99, 0.999, 0.9999])
+    est = sk1.quantile(q)
+    exact = np.quantile(x, q)
+    rel_err = np.abs(est - exact)/np.abs(exact)
+    print("quantiles:", np.round(est, 6))
+    print("exact    :", np.round(exact, 6))
+    assert(np.all(rel_err[[0, 1, 2, 4, 5, 6]] < 0.0101))
+    # quantiles between two values are interpolated as in np.quantile
+    sk = ReturnSketch(0.005)
+    sk.add([0.01, 0.02])
+    assert(np.all(np.abs(sk.quantile([0, 0.5, 1]) - [0.01, 0.015, 0.02]) <= 0.005*np.array([0.01, 0.015, 0.02])))
+
+def test_chunked_vs_single():
+    # chunked streaming counts every return exactly once
+    rng = np.random.default_rng(2)
+    prices = 100*np.exp(np.cumsum(0.01*rng.normal(size=10000)))
+    a = MultiHorizonReturns((1, 7, 60))
+    a.add_prices(prices)
+    b = MultiHorizonReturns((1, 7, 60))
+    for j in range(0, 10000, 333):
+        b.add_prices(prices[j:j+333])
+    for h in (1, 7, 60):
+        assert(a.sketches[h].count == 10000 - h)
+        assert(np.array_equal(a.sketches[h].pos, b.sketches[h].pos))
+
+def test_parallel_vs_sequential(filename, num_rows):
+    horizons = (1, 60, 1440)
+    seq = ingest_price_file(filename, horizons)
+    par = ingest_parallel(filename, num_rows, 4, horizons)
+    for h in horizons:
+        assert(seq.sketches[h].count == par.sketches[h].count)
+        assert(np.array_equal(seq.sketches[h].pos, par.sketches[h].pos))
+        assert(np.array_equal(seq.sketches[h].neg, par.sketches[h].neg))
+
+if __name__ == "__main__":
+    test_sketch_accuracy()
+    test_chunked_vs_single()
+    files = sys.argv[1:]
+    if len(files) == 0:
+        num_ticks = 2000000
+        files = [scenario_path("scenario1", PRICE_SCENARIO_FILE_NAME),
+                 os.path.join(tempfile.gettempdir(), "synthetic_prices.csv")]
+        # regenerate a stale or truncated file
+        if not os.path.exists(files[1]) or num_data_rows(files[1]) != num_ticks:
+            synthetic_price_file(files[1], num_ticks)
+        t0 = time.time()
+        test_parallel_vs_sequential(files[1], num_ticks)
+        print("parallel vs sequential ingestion ok,", np.round(time.time()-t0, 2), "s")
+    # horizons in ticks, e.g. 1 minute, 1 hour, 1 day for minute ticks
+    horizons = (1, 60, 1440)
+    markets = dict()
+    for filename in files:
+        t0 = time.time()
+        market = os.path.abspath(filename)
+        markets[market] = ingest_price_file(filename, horizons)
+        print(market, ": ingested", markets[market].sketches[1].count + 1, "ticks in",
+              np.round(time.time()-t0, 2), "s")
+        for h in horizons:
+            # r2pair/r3pair of get_DF_target_size
+            r2pair = markets[market].stress_returns(h)
+            print("  horizon", h, ": stress returns", r2pair, "(", markets[market].sketches[h].count, "returns )")
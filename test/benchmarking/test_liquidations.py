@@ -61,6 +61,50 @@ def is_margin_safe(pos, LockedInValueQC, cashCC, S2, S3, markPremium, collateral
     M = get_margin_balance_cc(pos, LockedInValueQC, S2, S3, markPremium, cashCC, collateral_currency_index)
     return M > np.abs(pos) * marginrate * base2collateral
 
+def get_margin_rates(traderPositionBC, fMaintenanceMarginRateAlpha, fInitialMarginRateAlpha,
+                     fMarginRateBeta, fInitialMarginRateCap):
+    # maintenance and initial margin rate for the position size as in __main__
+    cap = fInitialMarginRateCap - (fInitialMarginRateAlpha-fMaintenanceMarginRateAlpha)
+    mntnc_marginrate = np.minimum(fMaintenanceMarginRateAlpha + fMarginRateBeta*np.abs(traderPositionBC), cap)
+    initialMarginRate = np.minimum(fMaintenanceMarginRateAlpha + fMarginRateBeta*np.abs(traderPositionBC), fInitialMarginRateCap)
+    return mntnc_marginrate, initialMarginRate
+
+# vectorized versions of the functions above: all arguments can be numpy
+# arrays, including the collateral currency index (0: quote, 1: base, 2: quanto)
+
+def get_collateral_fx_vec(S2, S3, collateral_currency_index):
+    # value of one unit of collateral in quote currency
+    return np.where(collateral_currency_index == 0, 1, np.where(collateral_currency_index == 1, S2, S3))
+
+def getBase2CollateralFX_vec(indexS2, indexS3, markPremium, collateral_currency_index, at_mark_price):
+    s2 = markPremium + indexS2 if at_mark_price else indexS2
+    return s2/get_collateral_fx_vec(indexS2, indexS3, collateral_currency_index)
+
+def growToLot_vec(value, lotSize):
+    return np.where(value < 0, np.floor(value / lotSize), np.ceil(value / lotSize)) * lotSize
+
+def calculateLiquidationAmount_vec(S2, S3, margin_balance, targetMarginRate, maintMarginRate, traderPositionBC, liquidationFee, tradingFee, lotSize):
+    # S3: value of one unit of collateral in quote currency, as in calculateLiquidationAmount
+    f = (liquidationFee+tradingFee)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trade_amt = (np.abs(traderPositionBC)*targetMarginRate -  margin_balance *S3/S2) / \
+            ( np.sign(traderPositionBC) * (targetMarginRate - f) )
+        trade_amt_rounded = growToLot_vec(trade_amt, lotSize)
+    trade_amt_rounded = np.where(np.abs(trade_amt_rounded) >= np.abs(traderPositionBC), traderPositionBC, trade_amt_rounded)
+    # full liquidation if the margin balance does not exceed the fees
+    trade_amt_rounded = np.where(margin_balance > np.abs(traderPositionBC) * f * S2/S3, trade_amt_rounded, traderPositionBC)
+    is_safe = margin_balance * S3 / S2 > maintMarginRate*np.abs(traderPositionBC)
+    return np.where(is_safe, 0, trade_amt_rounded)
+
+def get_margin_balance_cc_vec(pos, LockedInValueQC, S2, S3, markPremium, cashCC, collateral_currency_index):
+    fx = get_collateral_fx_vec(S2, S3, collateral_currency_index)
+    return (pos*(S2+markPremium) - LockedInValueQC) / fx + cashCC
+
+def is_margin_safe_vec(pos, LockedInValueQC, cashCC, S2, S3, markPremium, collateral_currency_index, marginrate):
+    base2collateral = getBase2CollateralFX_vec(S2, S3, markPremium, collateral_currency_index, False)
+    M = get_margin_balance_cc_vec(pos, LockedInValueQC, S2, S3, markPremium, cashCC, collateral_currency_index)
+    return M > np.abs(pos) * marginrate * base2collateral
+
 def grow_to_lot(position, lot):
     # test grow to lot with just integer rounding
     sgn = -1 if position<0 else 1
@@ -88,6 +132,7 @@ def liquidation_test(traderPositionBC, liquidationFee, tradingFee, lotSize, S2_0
     print("margin balance = ", b1)
     print("required margin balance = ",required_balance)
     assert(required_balance <= b1)
+    return b0, liq_amt, b1, required_balance
 
 
 if __name__ == "__main__":
@@ -117,9 +162,8 @@ if __name__ == "__main__":
     fInitialMarginRateAlpha = 0.06
     tradingFee = 0.0006
     liquidationFee = 0.002
-    cap = fInitialMarginRateCap - (fInitialMarginRateAlpha-fMaintenanceMarginRateAlpha)
-    mntnc_marginrate = np.min((fMaintenanceMarginRateAlpha + fMarginRateBeta*np.abs(traderPositionBC), cap))
-    initialMarginRate = np.min((fMaintenanceMarginRateAlpha + fMarginRateBeta*np.abs(traderPositionBC), fInitialMarginRateCap))
+    mntnc_marginrate, initialMarginRate = get_margin_rates(traderPositionBC, fMaintenanceMarginRateAlpha,
+        fInitialMarginRateAlpha, fMarginRateBeta, fInitialMarginRateCap)
     print("mntnc_marginrate=",mntnc_marginrate)
     print("initialMarginRate=",initialMarginRate)
     liquidation_test(traderPositionBC, liquidationFee, tradingFee, lotSize, S2_0, cashCC, S2, mark_premium, mntnc_marginrate, initialMarginRate)